@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Incremental aggregation over the inputs of an aggregate masquerade device.
+#
+# Each input holds its latest value (None while it has no usable value).  set() updates one input and
+# result() returns the aggregate without looking at the other inputs:
+#
+#   mean, sum       running total and count.  The total is re-added from scratch every RESUM_EVERY
+#                   updates so floating point drift can't build up.
+#   min, max        heap of (value, input, version) with lazy deletion, so an update is O(log N)
+#   countTrue, any, all     running count of true inputs
+####################
+
+import heapq
+import json
+import math
+import threading
+
+VALUE_FUNCTIONS = ("mean", "min", "max", "sum", "countTrue")
+SENSOR_FUNCTIONS = ("any", "all")
+RESUM_EVERY = 1000
+
+TRUE_STRINGS = ("true", "on", "yes", "1", "open", "tripped")
+
+
+def parseInputs(text):
+    """
+    The aggInputs prop: a JSON list of [base device id, state key] pairs.  Raises ValueError if it's malformed.
+    """
+    if not text:
+        return []
+    inputs = json.loads(text)
+    if not isinstance(inputs, list):
+        raise ValueError("aggInputs is not a list")
+    return [(int(baseId), str(state)) for baseId, state in inputs]
+
+
+def formatInputs(inputs):
+    return json.dumps([[baseId, state] for baseId, state in inputs])
+
+
+def truthy(value):
+    if isinstance(value, str):
+        return value.strip().lower() in TRUE_STRINGS
+    return bool(value)
+
+
+class Aggregator(object):
+
+    def __init__(self, function, size):
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = [None] * size
+        self.present = 0
+        self.total = 0.0
+        self.updates = 0
+        self.trueCount = 0
+        self.heap = []
+        self.versions = [0] * size
+        self.sign = -1.0 if function == "max" else 1.0     # max keeps negated values in a min heap
+
+    def set(self, index, value):
+        """
+        Update one input and return the new aggregate.  value is a float for mean/min/max/sum, a bool
+        for countTrue/any/all, or None if the input has no usable value.
+        """
+        with self.lock:
+            old = self.values[index]
+            if old == value and (old is None) == (value is None):
+                return self.compute()
+            self.values[index] = value
+            if old is not None:
+                self.present -= 1
+            if value is not None:
+                self.present += 1
+
+            function = self.function
+            if function in ("mean", "sum"):
+                self.total += (value or 0.0) - (old or 0.0)
+                self.updates += 1
+                if self.updates >= RESUM_EVERY:
+                    self.total = math.fsum(v for v in self.values if v is not None)
+                    self.updates = 0
+            elif function in ("min", "max"):
+                self.versions[index] += 1
+                if value is not None:
+                    heapq.heappush(self.heap, (self.sign * value, index, self.versions[index]))
+                if len(self.heap) > 2 * len(self.values) + 16:
+                    self.rebuild()
+            else:
+                self.trueCount += (1 if value else 0) - (1 if old else 0)
+            return self.compute()
+
+    def saveState(self):
+        # the input values, for the warm-state snapshot
+        with self.lock:
+            return list(self.values)
+
+    def restoreState(self, values):
+        for index, value in enumerate(values[:len(self.values)]):
+            self.set(index, value)
+
+    def rebuild(self):
+        # drop the stale heap entries in one pass, so the heap stays O(N)
+        self.heap = [(self.sign * value, index, self.versions[index]) for index, value in enumerate(self.values) if value is not None]
+        heapq.heapify(self.heap)
+
+    def result(self):
+        with self.lock:
+            return self.compute()
+
+    def compute(self):
+        # caller holds the lock.  None if there's no input to aggregate.
+        function = self.function
+        if function == "countTrue":
+            return self.trueCount
+        if not self.present:
+            return None
+        if function == "sum":
+            return self.total
+        if function == "mean":
+            return self.total / self.present
+        if function in ("min", "max"):
+            heap = self.heap
+            while heap and heap[0][2] != self.versions[heap[0][1]]:
+                heapq.heappop(heap)
+            return self.sign * heap[0][0]
+        if function == "any":
+            return self.trueCount > 0
+        return self.trueCount == self.present
@@ -0,0 +1,196 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Catalog of installed Indigo plugins, for the device ConfigUI menus.
+#
+# The Plugins folders are only re-listed when their mtime changes, each bundle's Info.plist and
+# Actions.xml are only re-parsed when their own mtime changes, and Actions.xml isn't read at all
+# until a menu asks for that plugin's actions.
+####################
+
+import os
+import plistlib
+import threading
+import xml.etree.ElementTree as ET  # noqa
+
+PLUGIN_FOLDERS = (('Plugins', True), ('Plugins (Disabled)', False))
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class PluginBundle(object):
+    __slots__ = ("path", "enabled", "bundleId", "displayName", "plistMtime", "actionsMtime", "actionList", "actionFields")
+
+    def __init__(self, path, enabled):
+        self.path = path
+        self.enabled = enabled
+        self.bundleId = None
+        self.displayName = None
+        self.plistMtime = None
+        self.actionsMtime = None
+        self.actionList = None      # sorted [(action id, name)] for actions with a Name and CallbackMethod
+        self.actionFields = None    # action id -> sorted [(field id, field id)] of visible ConfigUI fields
+
+    @property
+    def plistPath(self):
+        return f"{self.path}/Contents/Info.plist"
+
+    @property
+    def actionsPath(self):
+        return f"{self.path}/Contents/Server Plugin/Actions.xml"
+
+
+class PluginCatalog(object):
+
+    def __init__(self, logger, installPath):
+        self.logger = logger
+        self.installPath = installPath
+        self.lock = threading.Lock()
+        self.folders = {}       # folder name -> (mtime, {bundle folder name: PluginBundle})
+        self.enabledById = {}   # bundleId -> PluginBundle in the enabled Plugins folder
+        self.pluginList = None  # cached result for pluginMenu()
+        self.changed = True     # set whenever a folder or bundle is reloaded
+
+    def refresh(self, allBundles=True):
+        # bring the catalog up to date with the Plugins folders.  If allBundles is False, only the folders are checked.
+        for folder, enabled in PLUGIN_FOLDERS:
+            folderPath = f"{self.installPath}/{folder}"
+            folderMtime = _mtime(folderPath)
+            cached = self.folders.get(folder)
+            if cached is None or cached[0] != folderMtime:
+                bundles = self.listFolder(folderPath, enabled, cached[1] if cached else {})
+                self.folders[folder] = (folderMtime, bundles)
+                self.changed = True
+            for bundle in self.folders[folder][1].values():
+                if allBundles or bundle.plistMtime is None:
+                    self.validatePlist(bundle)
+
+        if self.changed:
+            self.changed = False
+            self.pluginList = None
+            self.enabledById = {}
+            for bundle in self.folders[PLUGIN_FOLDERS[0][0]][1].values():
+                if bundle.bundleId is not None:
+                    self.enabledById[bundle.bundleId] = bundle
+
+    def listFolder(self, folderPath, enabled, previous):
+        bundles = {}
+        try:
+            names = os.listdir(folderPath)
+        except OSError as err:
+            self.logger.warning(f"PluginCatalog: Unable to list {folderPath}: {err}")
+            return bundles
+        for name in names:
+            # Check for Indigo Plugins and exclude 'system' plugins
+            if name.lower().endswith('.indigoplugin') and not name.startswith('.'):
+                bundles[name] = previous.get(name) or PluginBundle(f"{folderPath}/{name}", enabled)
+        return bundles
+
+    def validatePlist(self, bundle):
+        mtime = _mtime(bundle.plistPath)
+        if mtime == bundle.plistMtime:
+            return
+        bundle.plistMtime = mtime
+        bundle.bundleId = None
+        bundle.actionList = None
+        self.changed = True
+        try:
+            with open(bundle.plistPath, "rb") as fp:
+                pl = plistlib.load(fp)
+            bundle.bundleId = pl["CFBundleIdentifier"]
+            bundle.displayName = pl["CFBundleDisplayName"]
+        except Exception as err:
+            self.logger.warning(f"getPluginList: Unable to parse plist, skipping: {bundle.plistPath}, err = {err}")
+            bundle.bundleId = None
+        else:
+            self.logger.threaddebug(f"PluginCatalog: loaded {bundle.bundleId} from {bundle.path}")
+
+    def validateActions(self, bundle):
+        mtime = _mtime(bundle.actionsPath)
+        if bundle.actionList is not None and mtime == bundle.actionsMtime:
+            return
+        bundle.actionsMtime = mtime
+        bundle.actionList = []
+        bundle.actionFields = {}
+        if mtime is None:
+            return
+        try:
+            actions = ET.parse(bundle.actionsPath).getroot()
+        except Exception as err:
+            self.logger.warning(f"getActionList: Unable to parse {bundle.actionsPath}, err = {err}")
+            return
+
+        self.logger.debug(f"PluginCatalog: loading actions for bundleId = {bundle.bundleId}")
+        for action in actions:
+            if action.tag != "Action" or "id" not in action.attrib:
+                continue
+            actionId = action.attrib["id"]
+            name = action.find('Name')
+            callBack = action.find('CallbackMethod')
+            if name is not None and callBack is not None:
+                bundle.actionList.append((actionId, name.text))
+            fields = []
+            configUI = action.find('ConfigUI')
+            if configUI is not None:
+                for field in configUI:
+                    if "id" in field.attrib and not bool(field.attrib.get("hidden", None)):
+                        fields.append((field.attrib["id"], field.attrib["id"]))
+            fields.sort(key=lambda tup: tup[1])
+            bundle.actionFields[actionId] = fields
+        bundle.actionList.sort(key=lambda tup: tup[1])
+
+    def findEnabled(self, bundleId):
+        # the up to date enabled bundle for bundleId, or None
+        self.refresh(allBundles=False)
+        bundle = self.enabledById.get(bundleId)
+        if bundle is not None:
+            self.validatePlist(bundle)
+            if bundle.bundleId != bundleId:
+                # the bundle was replaced by a different plugin, recheck everything
+                self.refresh()
+                bundle = self.enabledById.get(bundleId)
+        return bundle
+
+    ########################################
+
+    def pluginMenu(self, excludeId):
+        """
+        [(bundleId, displayName)] for every installed plugin except excludeId, enabled plugins first.
+        """
+        with self.lock:
+            self.refresh()
+            if self.pluginList is None:
+                retList = []
+                for folder, enabled in PLUGIN_FOLDERS:
+                    tempList = []
+                    for bundle in self.folders[folder][1].values():
+                        if bundle.bundleId is None:
+                            continue
+                        # if disabled plugins folder, append 'Disabled' to name
+                        displayName = bundle.displayName if enabled else bundle.displayName + ' [Disabled]'
+                        tempList.append((bundle.bundleId, displayName))
+                    tempList.sort(key=lambda tup: tup[1])
+                    retList.extend(tempList)
+                self.pluginList = retList
+            return [item for item in self.pluginList if item[0] != excludeId]
+
+    def actionMenu(self, bundleId):
+        with self.lock:
+            bundle = self.findEnabled(bundleId)
+            if bundle is None:
+                return []
+            self.validateActions(bundle)
+            return list(bundle.actionList)
+
+    def actionFieldMenu(self, bundleId, actionId):
+        with self.lock:
+            bundle = self.findEnabled(bundleId)
+            if bundle is None:
+                return []
+            self.validateActions(bundle)
+            return list(bundle.actionFields.get(actionId, []))
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Name-sorted device listings for the device ConfigUI menus.
+#
+# Devices are bucketed by device class (protocol) and by pluginId.  The buckets are built with one
+# scan of indigo.devices the first time a menu needs them, then kept current from the plugin's
+# deviceCreated/deviceUpdated/deviceDeleted subscriptions.
+####################
+
+import threading
+
+import indigo
+
+# deviceClass menu values -> protocol
+DEVICE_CLASSES = {
+    "indigo.insteon": indigo.kProtocol.Insteon,
+    "indigo.zwave": indigo.kProtocol.ZWave,
+    "indigo.x10": indigo.kProtocol.X10,
+}
+PROTOCOL_CLASSES = {protocol: deviceClass for deviceClass, protocol in DEVICE_CLASSES.items()}
+
+
+class DeviceDirectory(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = False
+        self.buckets = {}       # bucket key -> {device id: name}
+        self.sorted = {}        # bucket key -> [(device id, name)] sorted by name, rebuilt on demand
+        self.deviceKeys = {}    # device id -> bucket key
+        self.stateLists = {}    # device id -> [(state key, state key)] sorted
+
+    @staticmethod
+    def bucketKey(dev):
+        if dev.protocol == indigo.kProtocol.Plugin:
+            return "plugin", dev.pluginId
+        return PROTOCOL_CLASSES.get(dev.protocol)
+
+    def build(self):
+        self.buckets = {}
+        self.sorted = {}
+        self.deviceKeys = {}
+        for dev in indigo.devices.iter():
+            self.add(dev)
+        self.built = True
+
+    def add(self, dev):
+        key = self.bucketKey(dev)
+        if key is None:
+            return
+        self.deviceKeys[dev.id] = key
+        self.buckets.setdefault(key, {})[dev.id] = dev.name
+        self.sorted.pop(key, None)
+
+    def remove(self, devId):
+        key = self.deviceKeys.pop(devId, None)
+        if key is None:
+            return
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            bucket.pop(devId, None)
+        self.sorted.pop(key, None)
+
+    def listing(self, key):
+        with self.lock:
+            if not self.built:
+                self.build()
+            retList = self.sorted.get(key)
+            if retList is None:
+                retList = sorted(self.buckets.get(key, {}).items(), key=lambda tup: tup[1])
+                self.sorted[key] = retList
+            return list(retList)
+
+    ########################################
+
+    def devicesForClass(self, deviceClass):
+        return self.listing(deviceClass)
+
+    def devicesForPlugin(self, pluginId):
+        return self.listing(("plugin", pluginId))
+
+    def stateList(self, dev):
+        with self.lock:
+            retList = self.stateLists.get(dev.id)
+            if retList is None:
+                retList = sorted((stateKey, stateKey) for stateKey in dev.states.keys())
+                self.stateLists[dev.id] = retList
+            return list(retList)
+
+    ########################################
+    # kept current from the indigo.devices subscription
+
+    def deviceCreated(self, dev):
+        with self.lock:
+            if self.built:
+                self.add(dev)
+
+    def deviceUpdated(self, oldDev, newDev):
+        if oldDev.name != newDev.name or oldDev.protocol != newDev.protocol or oldDev.pluginId != newDev.pluginId:
+            with self.lock:
+                if self.built:
+                    self.remove(newDev.id)
+                    self.add(newDev)
+        if newDev.id in self.stateLists and oldDev.states.keys() != newDev.states.keys():
+            with self.lock:
+                self.stateLists.pop(newDev.id, None)
+
+    def deviceDeleted(self, dev):
+        with self.lock:
+            self.remove(dev.id)
+            self.stateLists.pop(dev.id, None)
@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Asynchronous dispatch of masquerade device actions.
+#
+# Commands are queued FIFO per target (base device) and run by a small worker pool.  A target is only
+# ever handled by one worker at a time, so its commands run in order, while commands for different
+# targets run in parallel and a slow base plugin only holds up its own devices.
+#
+# Set-level style commands can be submitted with a key.  If the newest command still waiting for the
+# same target has the same key, it is superseded in place rather than queueing another one, so a
+# slider drag sends the latest level instead of replaying the whole ramp.  Only the newest waiting
+# command is ever replaced, so unkeyed commands (on, off, toggle) keep their place in the order.
+#
+# The last value submitted for each (target, key) is remembered, including once its command has been
+# taken by a worker, so relative changes (speed up one step) build on the level already asked for
+# rather than on a device state that hasn't caught up yet.  settle() forgets it when the target reports
+# that level, or reports anything once nothing for the key is waiting or running.
+####################
+
+import threading
+import time
+from collections import deque
+
+import indigo
+
+
+class Command(object):
+    __slots__ = ("label", "func", "args", "key", "queued")
+
+    def __init__(self, label, func, args, key=None):
+        self.label = label
+        self.func = func
+        self.args = args
+        self.key = key
+        self.queued = time.monotonic()
+
+
+class ActionDispatcher(object):
+
+    def __init__(self, logger, workers=4):
+        self.logger = logger
+        self.workerCount = workers
+        self.workers = []
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)     # workers wait here for ready targets
+        self.idle = threading.Condition(self.lock)     # drain() waits here for the queues to empty
+        self.queues = {}        # target -> deque of Commands not yet started
+        self.ready = deque()    # targets with queued commands and no worker running one
+        self.busy = set()       # targets that are in ready or have a command running
+        self.running = {}       # target -> Command a worker is running
+        self.latest = {}        # (target, key) -> last value submitted with submitLatest, until settled
+        self.depth = 0
+        self.stopping = False
+
+        self.maxDepth = 0
+        self.executed = 0
+        self.failed = 0
+        self.superseded = 0
+        self.totalWait = 0.0
+        self.totalRun = 0.0
+        self.maxWait = 0.0
+        self.maxRun = 0.0
+
+    def start(self):
+        self.stopping = False
+        for i in range(self.workerCount):
+            worker = threading.Thread(target=self.work, name=f"ActionDispatcher-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, timeout=5.0):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def submit(self, target, label, func, *args):
+        with self.cond:
+            self.enqueue(target, Command(label, func, args))
+
+    def enqueue(self, target, command):
+        # caller holds the lock
+        self.queues.setdefault(target, deque()).append(command)
+        self.depth += 1
+        self.maxDepth = max(self.maxDepth, self.depth)
+        if target not in self.busy:
+            self.busy.add(target)
+            self.ready.append(target)
+            self.cond.notify()
+
+    def submitLatest(self, target, key, label, func, fold):
+        """
+        Queue func(value), where value = fold(the last value submitted for target and key, or None).  If
+        the newest command waiting for target has the same key, it becomes func(value) instead of
+        queueing a second command.
+        """
+        with self.cond:
+            value = fold(self.latest.get((target, key)))
+            self.latest[(target, key)] = value
+            queue = self.queues.get(target)
+            if queue:
+                tail = queue[-1]
+                if tail.key == key:
+                    tail.label = label
+                    tail.func = func
+                    tail.args = (value,)
+                    self.superseded += 1
+                    return
+            self.enqueue(target, Command(label, func, (value,), key))
+
+    def settle(self, target, key, value):
+        # target now reports value for key
+        if (target, key) not in self.latest:
+            return
+        with self.cond:
+            latest = self.latest.get((target, key))
+            if latest is None:
+                return
+            if latest == value or not self.pending(target, key):
+                del self.latest[(target, key)]
+
+    def pending(self, target, key):
+        # caller holds the lock.  True if a command for key is waiting or running for target.
+        running = self.running.get(target)
+        if running is not None and running.key == key:
+            return True
+        return any(command.key == key for command in self.queues.get(target, ()))
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.ready and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                target = self.ready.popleft()
+                command = self.queues[target].popleft()
+                self.running[target] = command
+                self.depth -= 1
+
+            started = time.monotonic()
+            ok = True
+            try:
+                command.func(*command.args)
+            except Exception as err:
+                ok = False
+                self.logger.error(f"{command.label}: action failed: {err}")
+            finished = time.monotonic()
+
+            with self.cond:
+                del self.running[target]
+                self.record(started - command.queued, finished - started, ok)
+                if self.queues[target]:
+                    self.ready.append(target)
+                    self.cond.notify()
+                else:
+                    del self.queues[target]
+                    self.busy.discard(target)
+                    if not self.busy:
+                        self.idle.notify_all()
+
+    def record(self, wait, run, ok):
+        self.executed += 1
+        if not ok:
+            self.failed += 1
+        self.totalWait += wait
+        self.totalRun += run
+        self.maxWait = max(self.maxWait, wait)
+        self.maxRun = max(self.maxRun, run)
+
+    def drain(self, timeout=None):
+        # wait until every queued command has run.  Returns False on timeout.
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.idle.wait(remaining)
+        return True
+
+
+class PluginHandleCache(object):
+    """
+    Caches indigo.server.getPlugin() handles and their enabled status for ttl seconds.
+    """
+
+    def __init__(self, ttl=10.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.handles = {}       # pluginId -> (expires, plugin, enabled)
+
+    def get(self, pluginId):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.handles.get(pluginId)
+        if cached is not None and cached[0] > now:
+            return cached[1], cached[2]
+
+        plugin = indigo.server.getPlugin(pluginId)
+        enabled = plugin.isEnabled()
+        with self.lock:
+            self.handles[pluginId] = (now + self.ttl, plugin, enabled)
+        return plugin, enabled
+
+    def clear(self):
+        with self.lock:
+            self.handles = {}
@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Logging for the per-event and per-action paths.
+#
+# debug() and threaddebug() check a cached flag before doing anything, and messages use logging's
+# %-style arguments, so nothing is formatted when the level is off.  Callers pass values they already
+# have rather than building strings.
+#
+# warning() is rate limited per device and message kind: after one is logged, others of the same kind
+# for that device are counted for `interval` seconds, and the count is reported with the next one
+# logged (or by reportSuppressed() once the interval is up).
+####################
+
+import logging
+import threading
+import time
+
+THREADDEBUG = 5     # Indigo's level below DEBUG
+
+
+class HotLog(object):
+
+    def __init__(self, logger, level=logging.INFO, interval=60.0):
+        self.logger = logger
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.warnings = {}      # (device id, kind) -> [time last logged, suppressed count, message, args]
+        self.suppressed = 0
+        self.debugEnabled = False
+        self.threaddebugEnabled = False
+        self.setLevel(level)
+
+    def setLevel(self, level):
+        # called whenever the plugin's log level changes
+        self.debugEnabled = level <= logging.DEBUG
+        self.threaddebugEnabled = level <= THREADDEBUG
+
+    def debug(self, msg, *args):
+        if self.debugEnabled:
+            self.logger.debug(msg, *args, stacklevel=2)
+
+    def threaddebug(self, msg, *args):
+        if self.threaddebugEnabled:
+            self.logger.log(THREADDEBUG, msg, *args, stacklevel=2)
+
+    def warning(self, deviceId, kind, msg, *args):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.warnings.get((deviceId, kind))
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                entry[2] = msg
+                entry[3] = args
+                self.suppressed += 1
+                return
+            count = entry[1] if entry is not None else 0
+            self.warnings[(deviceId, kind)] = [now, 0, msg, args]
+        if count:
+            self.logger.warning(msg + " (suppressed %d similar messages)", *args, count, stacklevel=2)
+        else:
+            self.logger.warning(msg, *args, stacklevel=2)
+
+    def reportSuppressed(self):
+        # log the counts for warnings that stopped repeating, so suppressed messages aren't lost
+        now = time.monotonic()
+        report = []
+        with self.lock:
+            for key, entry in list(self.warnings.items()):
+                if now - entry[0] < self.interval:
+                    continue
+                if entry[1]:
+                    report.append((entry[2], entry[3], entry[1]))
+                del self.warnings[key]
+        for msg, args, count in report:
+            self.logger.warning(msg + " (suppressed %d similar messages)", *args, count)
+
+    def forget(self, deviceId):
+        with self.lock:
+            for key in [key for key in self.warnings if key[0] == deviceId]:
+                del self.warnings[key]
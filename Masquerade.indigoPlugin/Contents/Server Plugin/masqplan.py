@@ -0,0 +1,229 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Compiled mapping plans for masquerade devices.
+#
+# A plan holds everything the event and action paths need from a device's pluginProps, parsed and
+# validated once when the device starts (or its props change) instead of on every event.
+####################
+
+import indigo
+
+from scaling import makeCurve, BaseToMasq, MasqToBase, ScaleError
+from aggregate import parseInputs, VALUE_FUNCTIONS, SENSOR_FUNCTIONS
+from smoothing import SMOOTHING_MODES
+
+# masqSensor subtype -> (image when on, image when off)
+SENSOR_SUBTYPES = {
+    "Generic":      (indigo.kStateImageSel.NoImage, indigo.kStateImageSel.NoImage),
+    "MotionSensor": (indigo.kStateImageSel.MotionSensorTripped, indigo.kStateImageSel.MotionSensor),
+    "Power":        (indigo.kStateImageSel.PowerOn, indigo.kStateImageSel.PowerOff),
+}
+
+# masqValueSensor subtype -> (image, decimalPlaces, uiValue suffix)
+VALUE_SENSOR_SUBTYPES = {
+    "Generic":       (indigo.kStateImageSel.NoImage, None, None),
+    "Temperature-F": (indigo.kStateImageSel.TemperatureSensor, 1, u' °F'),
+    "Temperature-C": (indigo.kStateImageSel.TemperatureSensor, 1, u' °C'),
+    "Humidity":      (indigo.kStateImageSel.HumiditySensor, 0, u'%'),
+    "Luminance":     (indigo.kStateImageSel.LightSensor, 0, u' lux'),
+    "Luminance%":    (indigo.kStateImageSel.LightSensor, 0, u'%'),
+    "Energy":        (indigo.kStateImageSel.EnergyMeterOn, 0, u' watts'),
+    "ppm":           (indigo.kStateImageSel.NoImage, 0, u'ppm'),
+}
+
+# masqValueFormat -> formatter for the scaled action value
+VALUE_FORMATS = {
+    "Decimal":     str,
+    "Hexadecimal": '{:02x}'.format,
+    "Octal":       oct,
+}
+
+
+class PlanError(ValueError):
+    pass
+
+
+class MasqPlan(object):
+    """
+    Immutable, parsed form of a masquerade device's pluginProps.  Fields that don't apply to the
+    device type are None.
+    """
+    __slots__ = ("deviceTypeId", "handler", "baseDevice", "watches", "masqState",
+                 "matchString", "reverse", "onImage", "offImage",
+                 "image", "decimalPlaces", "uiSuffix",
+                 "throttled", "minUpdateInterval", "deadbandAbsolute", "deadbandPercent",
+                 "lowLimitState", "highLimitState", "reverseState",
+                 "lowLimitAction", "highLimitAction", "reverseAction", "valueFormat", "formatValue",
+                 "scaleCurve", "toMasq", "toBase",
+                 "devicePlugin", "masqAction", "masqValueField", "scaleFactor",
+                 "aggFunction", "inputs", "inputIndex",
+                 "smoothed", "smoothingMode", "smoothingAlpha", "windowSamples", "windowSeconds", "statsStates")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"MasqPlan is immutable, can't set '{name}'")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"MasqPlan is immutable, can't delete '{name}'")
+
+    def __repr__(self):
+        return f"MasqPlan({self.deviceTypeId}, baseDevice={self.baseDevice}, watches={self.watches})"
+
+
+def _int(props, key, default=None):
+    value = props.get(key, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise PlanError(f"invalid {key} = '{value}'")
+
+
+def _float(props, key, default=None):
+    value = props.get(key, default)
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise PlanError(f"invalid {key} = '{value}'")
+    if value < 0:
+        raise PlanError(f"{key} can't be negative")
+    return value
+
+
+def _sensorFields(props, fields):
+    subtype = props.get("masqSensorSubtype", "Generic")
+    if subtype not in SENSOR_SUBTYPES:
+        raise PlanError(f"unknown masqSensorSubtype '{subtype}'")
+    fields["onImage"], fields["offImage"] = SENSOR_SUBTYPES[subtype]
+    fields["matchString"] = props.get("matchString", "")
+    fields["reverse"] = bool(props.get("reverse", False))
+
+
+def _valueSensorFields(props, fields):
+    subtype = props.get("masqSensorSubtype", "Generic")
+    if subtype not in VALUE_SENSOR_SUBTYPES:
+        raise PlanError(f"unknown masqSensorSubtype '{subtype}'")
+    fields["image"], fields["decimalPlaces"], fields["uiSuffix"] = VALUE_SENSOR_SUBTYPES[subtype]
+    fields["minUpdateInterval"] = _float(props, "minUpdateInterval", 0)
+    fields["deadbandAbsolute"] = _float(props, "deadbandAbsolute", 0)
+    fields["deadbandPercent"] = _float(props, "deadbandPercent", 0)
+    fields["throttled"] = bool(fields["minUpdateInterval"] or fields["deadbandAbsolute"] or fields["deadbandPercent"])
+
+
+def compileAggregate(props, typeId, fields):
+    # aggregates follow any number of base device/state pairs, so there's no single baseDevice or masqState
+    if typeId == "masqAggregateValue":
+        _valueSensorFields(props, fields)
+        functions = VALUE_FUNCTIONS
+    else:
+        _sensorFields(props, fields)
+        functions = SENSOR_FUNCTIONS
+    function = props.get("aggFunction", functions[0])
+    if function not in functions:
+        raise PlanError(f"unknown aggFunction '{function}'")
+    fields["aggFunction"] = function
+
+    try:
+        inputs = tuple(parseInputs(props.get("aggInputs", "")))
+    except (TypeError, ValueError):
+        raise PlanError(f"invalid aggInputs = '{props.get('aggInputs')}'")
+    if not inputs:
+        raise PlanError("no inputs selected")
+    fields["inputs"] = inputs
+
+    # base device id -> ((input index, state key), ...), what an event from that device updates
+    inputIndex = {}
+    for index, (baseId, state) in enumerate(inputs):
+        inputIndex.setdefault(baseId, []).append((index, state))
+    fields["inputIndex"] = {baseId: tuple(entries) for baseId, entries in inputIndex.items()}
+    fields["watches"] = {baseId: tuple(state for index, state in entries) for baseId, entries in fields["inputIndex"].items()}
+    return MasqPlan(**fields)
+
+
+def compilePlan(device, handlers):
+    """
+    Build the MasqPlan for device.  handlers maps deviceTypeId to the update callable for that type.
+    Raises PlanError if the props can't be used.
+    """
+    props = device.pluginProps
+    typeId = device.deviceTypeId
+    handler = handlers.get(typeId)
+    if handler is None:
+        raise PlanError(f"unknown device type '{typeId}'")
+
+    fields = {"deviceTypeId": typeId, "handler": handler}
+    if typeId in ("masqAggregateValue", "masqAggregateSensor"):
+        return compileAggregate(props, typeId, fields)
+
+    baseDevice = _int(props, "baseDevice")
+    fields["baseDevice"] = baseDevice
+
+    if typeId == "masqSensor":
+        _sensorFields(props, fields)
+        fields["masqState"] = props.get("masqState")
+
+    elif typeId == "masqValueSensor":
+        _valueSensorFields(props, fields)
+        fields["masqState"] = props.get("masqState")
+        mode = props.get("smoothingMode", "none")
+        if mode not in SMOOTHING_MODES:
+            raise PlanError(f"unknown smoothingMode '{mode}'")
+        fields["smoothingMode"] = mode
+        fields["smoothingAlpha"] = _float(props, "smoothingAlpha", 0.3)
+        if not 0 < fields["smoothingAlpha"] <= 1:
+            raise PlanError(f"smoothingAlpha must be more than 0 and at most 1, not {fields['smoothingAlpha']}")
+        fields["windowSamples"] = _int(props, "windowSamples", 0)
+        if fields["windowSamples"] < 0:
+            raise PlanError("windowSamples can't be negative")
+        fields["windowSeconds"] = _float(props, "windowSeconds", 0)
+        fields["statsStates"] = bool(props.get("statsStates", False))
+        fields["smoothed"] = mode != "none" or fields["statsStates"]
+
+    elif typeId == "masqDimmer":
+        fields["masqState"] = props.get("masqState")
+        fields["lowLimitState"] = _int(props, "lowLimitState", 0)
+        fields["highLimitState"] = _int(props, "highLimitState", 100)
+        fields["reverseState"] = bool(props.get("reverseState", False))
+        if fields["highLimitState"] == fields["lowLimitState"]:
+            raise PlanError(f"highLimitState and lowLimitState are both {fields['lowLimitState']}")
+
+        fields["devicePlugin"] = props.get("devicePlugin")
+        fields["masqAction"] = props.get("masqAction", "---")
+        valueField = props.get("masqValueField")
+        fields["masqValueField"] = valueField if valueField and valueField != "---" else None
+        fields["lowLimitAction"] = _int(props, "lowLimitAction", 0)
+        fields["highLimitAction"] = _int(props, "highLimitAction", 100)
+        fields["reverseAction"] = bool(props.get("reverseAction", False))
+        valueFormat = props.get("masqValueFormat", "Decimal")
+        if valueFormat not in VALUE_FORMATS:
+            raise PlanError(f"unknown masqValueFormat '{valueFormat}'")
+        fields["valueFormat"] = valueFormat
+        fields["formatValue"] = VALUE_FORMATS[valueFormat]
+
+        # both directions are lookup tables built here, the event and action paths only index them
+        fields["scaleCurve"] = props.get("scaleCurve", "linear")
+        try:
+            curve = makeCurve(fields["scaleCurve"], props.get("curveParameter"), props.get("curveBreakpoints", ""))
+        except ScaleError as err:
+            raise PlanError(str(err))
+        fields["toMasq"] = BaseToMasq(curve, fields["lowLimitState"], fields["highLimitState"], fields["reverseState"])
+        fields["toBase"] = MasqToBase(curve, fields["lowLimitAction"], fields["highLimitAction"], fields["reverseAction"],
+                                      fields["formatValue"])
+
+    elif typeId == "masqSpeedControl":
+        fields["masqState"] = "brightnessLevel"
+        fields["scaleFactor"] = _int(props, "scaleFactor", 25)
+        if fields["scaleFactor"] <= 0:
+            raise PlanError(f"scaleFactor must be positive, not {fields['scaleFactor']}")
+
+    elif typeId == "masqSprinkler":
+        fields["masqState"] = "onOffState"
+
+    if not fields["masqState"]:
+        raise PlanError("no masqState selected")
+
+    fields["watches"] = {baseDevice: (fields["masqState"],)}
+    return MasqPlan(**fields)
@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Per-device counters and latency histograms for the plugin's hot paths.
+#
+# Every thread records into its own shard (a dict of device id -> DeviceMetrics), so recording never
+# takes a lock and callback threads never wait on each other.  Readers merge the shards; a reading
+# taken while other threads are recording may be off by the events in flight, which is fine for
+# diagnostics.
+####################
+
+import bisect
+import threading
+import time
+
+# counter indexes
+EVENTS_SEEN = 0             # base device changes for a device this masquerade follows
+EVENTS_MATCHED = 1          # ... where a watched state changed, so the masquerade was updated
+WRITES = 2                  # states written to the server
+CONVERSION_FAILURES = 3     # base values that couldn't be converted (masqValueSensor float())
+CLAMP_WARNINGS = 4          # base values outside the configured limits (scaleBaseToMasq)
+COUNTER_NAMES = ("seen", "matched", "writes", "convFail", "clamped")
+
+# histogram bucket upper bounds, in microseconds.  The last bucket is everything slower.
+BUCKET_BOUNDS_US = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 100000)
+_BOUNDS_NS = tuple(bound * 1000 for bound in BUCKET_BOUNDS_US)
+
+
+class Histogram(object):
+    __slots__ = ("count", "totalNs", "maxNs", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.totalNs = 0
+        self.maxNs = 0
+        self.buckets = [0] * (len(_BOUNDS_NS) + 1)
+
+    def observe(self, elapsedNs):
+        self.count += 1
+        self.totalNs += elapsedNs
+        if elapsedNs > self.maxNs:
+            self.maxNs = elapsedNs
+        self.buckets[bisect.bisect_left(_BOUNDS_NS, elapsedNs)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.totalNs += other.totalNs
+        self.maxNs = max(self.maxNs, other.maxNs)
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def percentileUs(self, pct):
+        # upper bound of the bucket holding the pct'th percentile (max for the overflow bucket)
+        if not self.count:
+            return 0.0
+        wanted = self.count * pct / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= wanted and n:
+                return float(BUCKET_BOUNDS_US[i]) if i < len(BUCKET_BOUNDS_US) else self.maxNs / 1000.0
+        return self.maxNs / 1000.0
+
+    def toDict(self):
+        return {"count": self.count, "totalMs": round(self.totalNs / 1e6, 3), "maxUs": round(self.maxNs / 1000.0, 1),
+                "p50Us": self.percentileUs(50), "p99Us": self.percentileUs(99), "buckets": list(self.buckets)}
+
+
+class DeviceMetrics(object):
+    __slots__ = ("counters", "histograms")
+
+    def __init__(self):
+        self.counters = [0] * len(COUNTER_NAMES)
+        self.histograms = {}    # operation name -> Histogram
+
+    def merge(self, other):
+        for i, n in enumerate(other.counters):
+            self.counters[i] += n
+        for op, hist in other.histograms.items():
+            mine = self.histograms.get(op)
+            if mine is None:
+                mine = self.histograms[op] = Histogram()
+            mine.merge(hist)
+
+    @property
+    def totalNs(self):
+        return sum(hist.totalNs for hist in self.histograms.values())
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()        # only taken to add a shard or reset
+        self.shards = []
+        self.started = time.time()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def device(self, deviceId):
+        shard = self.shard()
+        metrics = shard.get(deviceId)
+        if metrics is None:
+            metrics = shard[deviceId] = DeviceMetrics()
+        return metrics
+
+    def count(self, deviceId, counter, n=1):
+        self.device(deviceId).counters[counter] += n
+
+    def observe(self, deviceId, operation, elapsedNs):
+        histograms = self.device(deviceId).histograms
+        hist = histograms.get(operation)
+        if hist is None:
+            hist = histograms[operation] = Histogram()
+        hist.observe(elapsedNs)
+
+    def reset(self):
+        # shards stay registered to their threads, so empty them rather than replacing them
+        with self.lock:
+            for shard in self.shards:
+                shard.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        """
+        {device id: DeviceMetrics} merged across all threads.
+        """
+        with self.lock:
+            shards = list(self.shards)
+        merged = {}
+        for shard in shards:
+            for deviceId, metrics in list(shard.items()):
+                total = merged.get(deviceId)
+                if total is None:
+                    total = merged[deviceId] = DeviceMetrics()
+                total.merge(metrics)
+        return merged
+
+    def toDict(self, names=None, snapshot=None):
+        names = names or {}
+        devices = {}
+        for deviceId, metrics in (snapshot if snapshot is not None else self.snapshot()).items():
+            devices[str(deviceId)] = {
+                "name": names.get(deviceId),
+                "counters": dict(zip(COUNTER_NAMES, metrics.counters)),
+                "latency": {op: hist.toDict() for op, hist in metrics.histograms.items()},
+            }
+        return {"since": self.started, "time": time.time(), "bucketBoundsUs": list(BUCKET_BOUNDS_US), "devices": devices}
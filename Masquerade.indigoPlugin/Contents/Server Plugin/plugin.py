@@ -3,11 +3,25 @@
 ####################
 
 import os
-import plistlib
 import sys
+import json
 import time
 import logging
-import xml.etree.ElementTree as ET  # noqa
+import threading
+
+from masqplan import compilePlan, PlanError
+from statewriter import StateWriter
+from throttle import UpdateThrottle
+from catalog import PluginCatalog
+from devicedirectory import DeviceDirectory, DEVICE_CLASSES
+from dispatcher import ActionDispatcher, PluginHandleCache
+from tracer import EventRecorder
+from hotlog import HotLog
+from startsync import StartupSync
+from aggregate import Aggregator, parseInputs, formatInputs, truthy
+from smoothing import Smoother
+from warmstate import WarmStateStore
+from metrics import MetricsRegistry, EVENTS_SEEN, EVENTS_MATCHED, CONVERSION_FAILURES, CLAMP_WARNINGS, COUNTER_NAMES
 
 kCurDevVersCount = 0  # current version of plugin devices
 
@@ -26,18 +40,163 @@ class Plugin(indigo.PluginBase):
         self.logLevel = int(self.pluginPrefs.get("logLevel", logging.INFO))
         self.indigo_log_handler.setLevel(self.logLevel)
         self.logger.debug(f"logLevel = {str(self.logLevel)}")
+        self.hotLog = HotLog(self.logger, self.logLevel)     # per-event and per-action logging, follows logLevel
 
         self.masqueradeList = {}
+        self.masqPlans = {}             # masquerade device id -> MasqPlan
+        self.baseDeviceIndex = {}       # base device id -> {masquerade device id: tuple of watched state keys}
+        self.masqueradeWatches = {}     # masquerade device id -> {base device id: tuple of watched state keys}
+        self.aggregates = {}            # aggregate masquerade device id -> Aggregator
+        self.smoothers = {}             # masqValueSensor device id -> Smoother, if smoothing or window states are on
+        self.deviceLocks = {}           # masquerade device id -> Lock, one thread at a time runs its update handler
+        self.unsynced = {}              # masquerade device id -> base device ids it has handled, until its initial sync is done
+        self.metrics = MetricsRegistry()
+        self.metricsInterval = 0        # seconds between metrics snapshot files, 0 for none
+        self.nextMetricsSnapshot = None
+        self.stateWriter = StateWriter(self.logger, self.metrics)
+        self.throttle = UpdateThrottle(self.emitThrottledValue)
+        self.pluginCatalog = PluginCatalog(self.logger, indigo.server.getInstallFolderPath())
+        self.deviceDirectory = DeviceDirectory()
+        self.dispatcher = ActionDispatcher(self.logger)
+        self.pluginHandles = PluginHandleCache()
+        self.recorder = None
+        self.warmState = WarmStateStore(self.logger, f"{indigo.server.getInstallFolderPath()}/Preferences/Plugins/{self.pluginId}.warmstate.json")
+        self.warmRecords = {}           # device id -> warm-state record not (yet) restored into a running device
+        self.warmStateInterval = 300.0  # seconds between warm-state saves while running
+        self.nextWarmStateSave = None
+        self.smoothingInterval = 5.0    # seconds between re-evaluating smoothers whose output moves with time
+        self.nextSmoothingRefresh = None
+        self.startupSync = StartupSync(self.logger, self.resolveStartup, lambda baseDeviceId: indigo.devices[baseDeviceId],
+                                       self.syncDevice, self.stateWriter.flush)
+
+        self.updateHandlers = {
+            "masqSensor": self.updateSensor,
+            "masqValueSensor": self.updateValueSensor,
+            "masqDimmer": self.updateDimmer,
+            "masqSpeedControl": self.updateSpeedControl,
+            "masqSprinkler": self.updateSprinkler,
+            "masqAggregateValue": self.updateAggregateValue,
+            "masqAggregateSensor": self.updateAggregateSensor,
+        }
 
     def startup(self):
         self.logger.info("Starting Masquerade")
+        self.loadWarmState()
+        self.nextWarmStateSave = time.monotonic() + self.warmStateInterval
+        self.nextSmoothingRefresh = time.monotonic() + self.smoothingInterval
         indigo.devices.subscribeToChanges()
+        self.startupSync.start()
+        self.dispatcher.start()
+        self.configureTracing()
+        self.configureMetrics()
 
     def shutdown(self):
         self.logger.info("Shutting down Masquerade")
+        self.startupSync.stop()
+        self.dispatcher.stop()
+        self.saveWarmState()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.metricsInterval:
+            self.writeMetricsSnapshot()
+
+    def runConcurrentThread(self):
+        # sends values held back by the rate limiter once their update interval is up
+        while not self.stopThread:
+            delay = self.throttle.runDue(time.monotonic())
+            if self.nextSmoothingRefresh is not None and time.monotonic() >= self.nextSmoothingRefresh:
+                self.refreshSmoothers()
+                self.nextSmoothingRefresh = time.monotonic() + self.smoothingInterval
+            self.stateWriter.flush()
+            if self.recorder is not None:
+                self.recorder.flush()
+            self.hotLog.reportSuppressed()
+            if self.nextMetricsSnapshot is not None and time.monotonic() >= self.nextMetricsSnapshot:
+                self.writeMetricsSnapshot()
+                self.nextMetricsSnapshot = time.monotonic() + self.metricsInterval
+            if self.nextWarmStateSave is not None and time.monotonic() >= self.nextWarmStateSave:
+                self.saveWarmState()
+                self.nextWarmStateSave = time.monotonic() + self.warmStateInterval
+            self.throttle.wait(1.0 if delay is None else min(delay, 1.0))
+
+    def stopConcurrentThread(self):
+        indigo.PluginBase.stopConcurrentThread(self)
+        self.throttle.wakeup()
 
     def deviceStartComm(self, device):
+        # register the device now, the version upgrade and initial sync are done in the background by startupSync
+        self.logger.debug(f"Adding Device {device.name} ({device.id}) to device list")
+        if device.id in self.masqueradeList:
+            self.logger.warning(f"{device.name}: Device was already started, restarting it")
+            self.deviceStopComm(device)
+        self.masqueradeList[device.id] = device
+        self.deviceLocks[device.id] = threading.Lock()
+        self.stateWriter.seed(device)
+        if not self.compileDevice(device):
+            return
+        if self.recorder is not None:
+            self.traceDevice(device)
+        self.queueSync(device.id)
+
+    def deviceStopComm(self, device):
+        self.logger.debug(f"Removing Device {device.name} ({device.id}) from device list")
+        record = self.warmStateRecord(device.id)
+        if record is not None:
+            # kept for the next start of this device, and saved with the snapshot at shutdown
+            self.warmRecords[device.id] = record
+        if self.masqueradeList.pop(device.id, None) is None:
+            self.logger.debug(f"{device.name}: Device was not started")
+        self.startupSync.discard(device.id)
+        self.unsynced.pop(device.id, None)
+        self.deviceLocks.pop(device.id, None)
+        self.masqPlans.pop(device.id, None)
+        self.aggregates.pop(device.id, None)
+        self.smoothers.pop(device.id, None)
+        self.unindexDevice(device.id)
+        self.stateWriter.forget(device.id)
+        self.throttle.forget(device.id)
+        self.hotLog.forget(device.id)
+
+    def waitForStartup(self, timeout=None):
+        # block until every started device has had its initial sync.  Returns False on timeout.
+        return self.startupSync.wait(timeout)
+
+    ########################################
+    # Staged startup
+    ########################################
 
+    def queueSync(self, deviceId):
+        # have startupSync give the device its initial values from its base devices
+        self.unsynced[deviceId] = set()
+        self.startupSync.add(deviceId)
+
+    def resolveStartup(self, deviceId):
+        # the name and base devices for a queued device, or None if it has been stopped or can't be compiled
+        device = self.masqueradeList.get(deviceId)
+        plan = self.masqPlans.get(deviceId)
+        if device is None or plan is None:
+            return None
+        return device.name, tuple(plan.watches)
+
+    def syncDevice(self, deviceId, baseDevices, missing):
+        # runs on the StartupSync thread
+        device = self.masqueradeList.get(deviceId)
+        plan = self.masqPlans.get(deviceId)
+        if device is None or plan is None:
+            return
+        self.upgradeDevice(device)
+        if plan.statsStates is not None and plan.statsStates != ("windowMin" in device.states):
+            # window states turned on or off, have Indigo fetch the new state list
+            device.stateListOrDisplayStateIdChanged()
+        # baseDevices only has the ones that exist, an aggregate syncs whichever inputs it can.  Inputs restored
+        # from the warm state for a base device deleted while the plugin was stopped are cleared.
+        for baseDeviceId in missing:
+            self.removeAggregateInput(device, baseDeviceId)
+        for baseDevice in baseDevices.values():
+            self.updateDevice(device, None, baseDevice)
+        self.unsynced.pop(deviceId, None)
+
+    def upgradeDevice(self, device):
         instanceVers = int(device.pluginProps.get('devVersCount', 0))
         if instanceVers >= kCurDevVersCount:
             self.logger.debug(f"{device.name}: Device Version is up to date")
@@ -51,16 +210,286 @@ class Plugin(indigo.PluginBase):
         else:
             self.logger.error(f"Unknown device version: {instanceVers} for device {device.name}")
 
-        self.logger.debug(f"Adding Device {device.name} ({device.id}) to device list")
-        assert device.id not in self.masqueradeList
-        self.masqueradeList[device.id] = device
-        baseDevice = indigo.devices[int(device.pluginProps["baseDevice"])]
-        self.updateDevice(device, None, baseDevice)
+    def migrateWarmState(self, record, instanceVers):
+        # the warm-state side of upgradeDevice: bring a record saved under an older devVersCount up to
+        # kCurDevVersCount.  Return None to drop it.
+        record["devVersCount"] = kCurDevVersCount
+        return record
 
-    def deviceStopComm(self, device):
-        self.logger.debug(f"Removing Device {device.name} ({device.id}) from device list")
-        assert device.id in self.masqueradeList
-        del self.masqueradeList[device.id]
+    def getDeviceStateList(self, dev):
+        stateList = indigo.PluginBase.getDeviceStateList(self, dev)
+        if dev.deviceTypeId == "masqValueSensor" and dev.pluginProps.get("statsStates", False):
+            stateList.append(self.getDeviceStateDictForRealType("windowMin", "Window Minimum Changed", "Window Minimum"))
+            stateList.append(self.getDeviceStateDictForRealType("windowMax", "Window Maximum Changed", "Window Maximum"))
+            stateList.append(self.getDeviceStateDictForRealType("rateOfChange", "Rate of Change Changed", "Rate of Change (per minute)"))
+        return stateList
+
+    ########################################
+    # Mapping plans and base device index
+    ########################################
+
+    def compileDevice(self, device):
+        # (re)build the mapping plan for device and index it by base device.  Returns False if the props are unusable.
+        saved = self.warmRecords.pop(device.id, None)
+        live = self.warmStateRecord(device.id)      # carry runtime state over a recompile if the settings allow
+        try:
+            plan = compilePlan(device, self.updateHandlers)
+        except PlanError as err:
+            self.logger.error(f"{device.name}: Invalid configuration, device will not be updated: {err}")
+            self.masqPlans.pop(device.id, None)
+            self.aggregates.pop(device.id, None)
+            self.smoothers.pop(device.id, None)
+            self.unindexDevice(device.id)
+            return False
+
+        self.logger.debug(f"{device.name}: compiled {plan}")
+        self.masqPlans[device.id] = plan
+        if plan.inputs is not None:
+            self.aggregates[device.id] = Aggregator(plan.aggFunction, len(plan.inputs))
+        else:
+            self.aggregates.pop(device.id, None)
+        if plan.smoothed:
+            self.smoothers[device.id] = Smoother(plan.smoothingMode, plan.smoothingAlpha, plan.windowSamples, plan.windowSeconds, plan.statsStates)
+        else:
+            self.smoothers.pop(device.id, None)
+        self.restoreWarmState(device, plan, live or saved)
+        self.indexDevice(device.id, plan.watches)
+        return True
+
+    def indexDevice(self, deviceId, watches):
+        self.unindexDevice(deviceId)
+        self.masqueradeWatches[deviceId] = watches
+        for baseDeviceId, stateKeys in watches.items():
+            self.baseDeviceIndex.setdefault(baseDeviceId, {})[deviceId] = stateKeys
+
+    def unindexDevice(self, deviceId):
+        watches = self.masqueradeWatches.pop(deviceId, None)
+        if not watches:
+            return
+        for baseDeviceId in watches:
+            watchers = self.baseDeviceIndex.get(baseDeviceId)
+            if watchers is None:
+                continue
+            watchers.pop(deviceId, None)
+            if not watchers:
+                del self.baseDeviceIndex[baseDeviceId]
+
+    ########################################
+    # Warm-state snapshot
+    ########################################
+
+    @staticmethod
+    def smootherConfig(plan):
+        return [plan.smoothingMode, plan.smoothingAlpha, plan.windowSamples, plan.windowSeconds]
+
+    @staticmethod
+    def aggregateConfig(plan):
+        return [plan.aggFunction, [[baseId, state] for baseId, state in plan.inputs]]
+
+    def loadWarmState(self):
+        # called from startup, before Indigo starts any devices
+        self.warmRecords = {}
+        for deviceId, record in self.warmState.load().items():
+            if not isinstance(record, dict):
+                continue
+            instanceVers = int(record.get("devVersCount", 0))
+            if instanceVers < kCurDevVersCount:
+                record = self.migrateWarmState(record, instanceVers)
+            elif instanceVers > kCurDevVersCount:
+                record = None   # saved by a newer version of the plugin
+            if record is not None:
+                self.warmRecords[deviceId] = record
+
+    def saveWarmState(self):
+        records = dict(self.warmRecords)
+        for deviceId in list(self.masqueradeList):
+            record = self.warmStateRecord(deviceId)
+            if record is not None:
+                records[deviceId] = record
+        if not records and not self.warmState.loaded and not self.warmState.saves:
+            return
+        self.warmState.save(records)
+
+    def warmStateRecord(self, deviceId):
+        # the runtime state of a running device for the snapshot, or None if it has none
+        device = self.masqueradeList.get(deviceId)
+        plan = self.masqPlans.get(deviceId)
+        if device is None or plan is None:
+            return None
+        record = {}
+        smoother = self.smoothers.get(deviceId)
+        if smoother is not None:
+            record["smoother"] = dict(smoother.saveState(), config=self.smootherConfig(plan))
+        aggregate = self.aggregates.get(deviceId)
+        if aggregate is not None:
+            record["aggregate"] = {"config": self.aggregateConfig(plan), "values": aggregate.saveState()}
+        if not record:
+            return None
+        record["devVersCount"] = int(device.pluginProps.get("devVersCount", 0))
+        return record
+
+    def restoreWarmState(self, device, plan, record):
+        # refill a freshly compiled device's smoother and aggregate from a saved record whose settings still match
+        if not record:
+            return
+        try:
+            smoother = self.smoothers.get(device.id)
+            saved = record.get("smoother")
+            if smoother is not None and saved and saved.get("config") == self.smootherConfig(plan):
+                smoother.restoreState(saved)
+                self.logger.debug(f"{device.name}: restored {len(smoother.buffer)} readings to the smoothing window")
+            aggregate = self.aggregates.get(device.id)
+            saved = record.get("aggregate")
+            if aggregate is not None and saved and saved.get("config") == self.aggregateConfig(plan):
+                aggregate.restoreState(saved["values"])
+                self.logger.debug(f"{device.name}: restored aggregate inputs, {plan.aggFunction} = {aggregate.result()}")
+        except (TypeError, ValueError, KeyError, AttributeError) as err:
+            self.logger.warning(f"{device.name}: Unable to restore warm state, starting cold: {err}")
+            if device.id in self.smoothers:
+                self.smoothers[device.id] = Smoother(plan.smoothingMode, plan.smoothingAlpha, plan.windowSamples, plan.windowSeconds, plan.statsStates)
+            if device.id in self.aggregates:
+                self.aggregates[device.id] = Aggregator(plan.aggFunction, len(plan.inputs))
+
+    ########################################
+    # Event tracing
+    ########################################
+
+    def configureTracing(self):
+        enabled = bool(self.pluginPrefs.get("traceEnabled", False))
+        if not enabled:
+            if self.recorder is not None:
+                self.logger.info("Event tracing stopped")
+                recorder, self.recorder = self.recorder, None
+                recorder.close()
+            return
+
+        path = f"{indigo.server.getLogsFolderPath(pluginId=self.pluginId)}/trace.jsonl"
+        try:
+            maxBytes = int(float(self.pluginPrefs.get("traceMaxSize", 10)) * 1024 * 1024)
+        except ValueError:
+            maxBytes = 10 * 1024 * 1024
+        if self.recorder is not None and self.recorder.path == path and self.recorder.maxBytes == maxBytes:
+            return
+        if self.recorder is not None:
+            self.recorder.close()
+
+        recorder = EventRecorder(self.logger, path, maxBytes, header=self.traceHeader)
+        try:
+            recorder.open()
+        except OSError as err:
+            self.logger.error(f"Unable to open event trace {path}: {err}")
+            self.recorder = None
+            return
+        self.recorder = recorder
+        self.logger.info(f"Event tracing to {path}")
+
+    def traceHeader(self):
+        # masquerade devices and the devices they follow, written at the start of each trace file
+        records = []
+        for masqDevice in list(self.masqueradeList.values()):
+            records.append(EventRecorder.masqueradeRecord(masqDevice))
+        for baseDeviceId in list(self.baseDeviceIndex):
+            try:
+                records.append(EventRecorder.deviceRecord(indigo.devices[baseDeviceId]))
+            except KeyError:
+                pass
+        return records
+
+    def traceDevice(self, device):
+        self.recorder.emit(EventRecorder.masqueradeRecord(device))
+        for baseDeviceId in self.masqPlans[device.id].watches:
+            if baseDeviceId not in self.recorder.seen:
+                try:
+                    self.recorder.emit(EventRecorder.deviceRecord(indigo.devices[baseDeviceId]))
+                except KeyError:
+                    pass
+
+    ########################################
+    # Performance metrics
+    ########################################
+
+    def configureMetrics(self):
+        try:
+            self.metricsInterval = max(0.0, float(self.pluginPrefs.get("metricsSnapshotInterval", 0)) * 60.0)
+        except ValueError:
+            self.metricsInterval = 0
+        self.nextMetricsSnapshot = time.monotonic() + self.metricsInterval if self.metricsInterval else None
+
+    def metricsDeviceName(self, deviceId):
+        device = self.masqueradeList.get(deviceId)
+        if device is not None:
+            return device.name
+        try:
+            return indigo.devices[deviceId].name
+        except KeyError:
+            return str(deviceId)
+
+    def writeMetricsSnapshot(self):
+        # written to a temporary file and renamed, so readers never see a partial snapshot
+        path = f"{indigo.server.getLogsFolderPath(pluginId=self.pluginId)}/metrics.json"
+        snapshot = self.metrics.snapshot()
+        names = {deviceId: self.metricsDeviceName(deviceId) for deviceId in snapshot}
+        data = self.metrics.toDict(names, snapshot)
+        data["startup"] = {"seconds": self.startupSync.startupTime, "synced": self.startupSync.synced,
+                           "fetched": self.startupSync.fetched, "errors": self.startupSync.errors, "pending": self.startupSync.pending}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as fp:
+                json.dump(data, fp, indent=1, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            self.logger.error(f"Unable to write metrics snapshot {path}: {err}")
+
+    ########################################
+    # Menu methods
+    ########################################
+
+    def logStatistics(self, valuesDict=None, typeId=None):
+        sync = self.startupSync
+        if sync.startupTime is not None:
+            self.logger.info(f"Startup: {sync.synced} devices synced, first pass in {sync.startupTime:.2f} s, "
+                             f"{sync.fetched} base devices fetched in {sync.batches} batches, {sync.errors} errors, {sync.pending} pending")
+        else:
+            self.logger.info(f"Startup: in progress, {sync.synced} devices synced, {sync.pending} pending")
+        writer = self.stateWriter
+        self.logger.info(f"State writes: {writer.statesWritten} written, {writer.statesSuppressed} suppressed as unchanged, "
+                         f"{writer.imagesSuppressed} image writes suppressed, {writer.serverCalls} server calls")
+        self.logger.info(f"Rate limiting: {self.throttle.coalesced} values coalesced, {self.throttle.deadbanded} inside deadband, "
+                         f"{len(self.throttle.pending)} pending")
+        dispatcher = self.dispatcher
+        if dispatcher.executed:
+            self.logger.info(f"Action dispatch: {dispatcher.depth} queued (max {dispatcher.maxDepth}), {dispatcher.executed} executed, "
+                             f"{dispatcher.superseded} superseded, {dispatcher.failed} failed, "
+                             f"wait avg {1000.0 * dispatcher.totalWait / dispatcher.executed:.1f} ms / max {1000.0 * dispatcher.maxWait:.1f} ms, "
+                             f"run avg {1000.0 * dispatcher.totalRun / dispatcher.executed:.1f} ms / max {1000.0 * dispatcher.maxRun:.1f} ms")
+        else:
+            self.logger.info(f"Action dispatch: {dispatcher.depth} queued, no actions executed")
+        warmState = self.warmState
+        lastSave = time.strftime("%H:%M:%S", time.localtime(warmState.lastSave)) if warmState.lastSave else "never"
+        self.logger.info(f"Warm state: {warmState.loaded} devices loaded at startup, {len(self.warmRecords)} not restored, "
+                         f"{warmState.saves} saves, last {lastSave}")
+
+    def logPerformanceMetrics(self, valuesDict=None, typeId=None, topN=20):
+        snapshot = self.metrics.snapshot()
+        if not snapshot:
+            self.logger.info("Performance metrics: nothing recorded yet")
+            return
+        ranked = sorted(snapshot.items(), key=lambda item: item[1].totalNs, reverse=True)[:topN]
+        lines = [f"Performance metrics, top {len(ranked)} of {len(snapshot)} devices by time spent "
+                 f"(over {time.time() - self.metrics.started:.0f} s):",
+                 f"{'Device':<40}{'kind':>6}" + "".join(f"{name:>10}" for name in COUNTER_NAMES) + f"{'total ms':>12}"]
+        for deviceId, metrics in ranked:
+            kind = "masq" if deviceId in self.masqueradeList else "base"
+            lines.append(f"{self.metricsDeviceName(deviceId)[:39]:<40}{kind:>6}" + "".join(f"{n:>10}" for n in metrics.counters)
+                         + f"{metrics.totalNs / 1e6:>12.1f}")
+            for operation, hist in sorted(metrics.histograms.items()):
+                lines.append(f"    {operation:<36}{hist.count:>8} calls, total {hist.totalNs / 1e6:.1f} ms, "
+                             f"p50 <= {hist.percentileUs(50):.0f} us, p99 <= {hist.percentileUs(99):.0f} us, max {hist.maxNs / 1000.0:.0f} us")
+        self.logger.info("\n".join(lines))
+
+    def resetPerformanceMetrics(self, valuesDict=None, typeId=None):
+        self.metrics.reset()
+        self.logger.info("Performance metrics reset")
 
     ########################################
     # ConfigUI methods
@@ -70,397 +499,560 @@ class Plugin(indigo.PluginBase):
         if not userCancelled:
             self.logLevel = int(self.pluginPrefs.get("logLevel", logging.INFO))
             self.indigo_log_handler.setLevel(self.logLevel)
+            self.hotLog.setLevel(self.logLevel)
             self.logger.debug(f"logLevel = {self.logLevel}")
+            self.configureTracing()
+            self.configureMetrics()
 
     ################################################################################
     #   Scaling methods
     ################################################################################
 
-    def scaleBaseToMasq(self, masqDevice, val):
-        lowLimit = int(masqDevice.pluginProps["lowLimitState"])
-        highLimit = int(masqDevice.pluginProps["highLimitState"])
-        reverse = bool(masqDevice.pluginProps["reverseState"])
+    def scaleBaseToMasq(self, masqDevice, plan, val):
+        t0 = time.perf_counter_ns()
+        toMasq = plan.toMasq
+        lowLimit = toMasq.minimum
+        highLimit = toMasq.maximum
 
         if val < lowLimit:
-            self.logger.warning(f"scaleBaseToMasq: Input value for {masqDevice.name} is lower than expected: {val}")
+            self.hotLog.warning(masqDevice.id, "low", "scaleBaseToMasq: Input value for %s is lower than expected: %s", masqDevice.name, val)
+            self.metrics.count(masqDevice.id, CLAMP_WARNINGS)
             val = lowLimit
         elif val > highLimit:
-            self.logger.warning(f"scaleBaseToMasq: Input value for {masqDevice.name} is higher than expected: {val}")
+            self.hotLog.warning(masqDevice.id, "high", "scaleBaseToMasq: Input value for %s is higher than expected: %s", masqDevice.name, val)
+            self.metrics.count(masqDevice.id, CLAMP_WARNINGS)
             val = highLimit
 
-        scaled = int((val - lowLimit) * (100.0 / (highLimit - lowLimit)))
+        scaled = toMasq(val)
 
-        if reverse:
-            scaled = 100 - scaled
-
-        self.logger.debug(
-            f"scaleBaseToMasq: lowLimit = {lowLimit}, highLimit = {highLimit}, reverse = {str(reverse)}, input = {val}, scaled = {scaled}")
+        self.hotLog.debug("scaleBaseToMasq: lowLimit = %s, highLimit = %s, reverse = %s, curve = %s, input = %s, scaled = %s",
+                          plan.lowLimitState, plan.highLimitState, plan.reverseState, plan.scaleCurve, val, scaled)
+        self.metrics.observe(masqDevice.id, "scaleBaseToMasq", time.perf_counter_ns() - t0)
         return scaled
 
-    def scaleMasqToBase(self, masqDevice, val):
-        lowLimit = int(masqDevice.pluginProps["lowLimitAction"])
-        highLimit = int(masqDevice.pluginProps["highLimitAction"])
-        reverse = bool(masqDevice.pluginProps["reverseAction"])
-        valFormat = masqDevice.pluginProps["masqValueFormat"]
-
-        scaled = int((val * (highLimit - lowLimit) / 100.0) + lowLimit)
+    def scaleMasqToBase(self, masqDevice, plan, val):
+        t0 = time.perf_counter_ns()
+        scaledString = plan.toBase(val)
 
-        if reverse:
-            scaled = highLimit - (scaled - lowLimit)
-
-        if valFormat == "Decimal":
-            scaledString = str(scaled)
-        elif valFormat == "Hexadecimal":
-            scaledString = '{:02x}'.format(scaled)
-        elif valFormat == "Octal":
-            scaledString = oct(scaled)
-        else:
-            self.logger.error(f"scaleMasqToBase: Unknown masqValueFormat = {valFormat}")
-            return None
-
-        self.logger.debug(
-            f"scaleMasqToBase: lowLimit = {lowLimit}, highLimit = {highLimit}, reverse = {str(reverse)}, input = {val}, format = {valFormat}, scaled = {scaledString}")
+        self.hotLog.debug("scaleMasqToBase: lowLimit = %s, highLimit = %s, reverse = %s, curve = %s, input = %s, format = %s, scaled = %s",
+                          plan.lowLimitAction, plan.highLimitAction, plan.reverseAction, plan.scaleCurve, val, plan.valueFormat, scaledString)
+        self.metrics.observe(masqDevice.id, "scaleMasqToBase", time.perf_counter_ns() - t0)
         return scaledString
 
     ###############################################################################
     # delegate methods for indigo.devices.subscribeToChanges()
     ###############################################################################
 
+    def deviceCreated(self, newDevice):
+        indigo.PluginBase.deviceCreated(self, newDevice)
+        self.deviceDirectory.deviceCreated(newDevice)
+
     def deviceDeleted(self, delDevice):
         indigo.PluginBase.deviceDeleted(self, delDevice)
-
-        for myDeviceId, myDevice in sorted(self.masqueradeList.items()):
-            baseDevice = int(myDevice.pluginProps["baseDevice"])
-            if delDevice.id == baseDevice:
-                self.logger.info(f"A device ({delDevice.name}) that was being Masqueraded has been deleted.  Disabling {myDevice.name}")
-                indigo.device.enable(myDevice, value=False)  # disable it
+        self.deviceDirectory.deviceDeleted(delDevice)
+        self.warmRecords.pop(delDevice.id, None)
+        if self.recorder is not None:
+            self.recorder.deviceDeleted(delDevice)
+
+        watchers = self.baseDeviceIndex.get(delDevice.id)
+        if not watchers:
+            return
+
+        for myDeviceId in list(watchers):
+            myDevice = self.masqueradeList[myDeviceId]
+            if myDeviceId in self.aggregates:
+                # an aggregate carries on without the deleted input
+                self.logger.info(f"A device ({delDevice.name}) that was an input to {myDevice.name} has been deleted.  Removing it from the aggregate")
+                self.removeAggregateInput(myDevice, delDevice.id)
+                continue
+            self.logger.info(f"A device ({delDevice.name}) that was being Masqueraded has been deleted.  Disabling {myDevice.name}")
+            indigo.device.enable(myDevice, value=False)  # disable it
+        self.stateWriter.flush()
 
     def deviceUpdated(self, oldDevice, newDevice):
         indigo.PluginBase.deviceUpdated(self, oldDevice, newDevice)
-
-        for masqDeviceId, masqDevice in sorted(self.masqueradeList.items()):
-            baseDevice = int(masqDevice.pluginProps["baseDevice"])
-            if oldDevice.id == baseDevice:
-                self.updateDevice(masqDevice, oldDevice, newDevice)
+        self.deviceDirectory.deviceUpdated(oldDevice, newDevice)
+        if self.recorder is not None:
+            self.recorder.deviceUpdated(oldDevice, newDevice)
+
+        if newDevice.id in self.masqueradeList:
+            # one of our own devices, keep the cached copy and the plan current if the props changed
+            self.masqueradeList[newDevice.id] = newDevice
+            if oldDevice.pluginProps != newDevice.pluginProps:
+                self.hotLog.debug("%s: pluginProps changed, recompiling", newDevice.name)
+                if self.compileDevice(newDevice) and newDevice.id in self.aggregates:
+                    # the new aggregate starts empty, fill it from the base devices
+                    self.queueSync(newDevice.id)
+
+        watchers = self.baseDeviceIndex.get(newDevice.id)
+        if not watchers:
+            return
+
+        t0 = time.perf_counter_ns()
+        metrics = self.metrics
+        oldStates = oldDevice.states
+        newStates = newDevice.states
+        for masqDeviceId, stateKeys in list(watchers.items()):
+            metrics.count(masqDeviceId, EVENTS_SEEN)
+            for key in stateKeys:
+                if oldStates.get(key) != newStates.get(key):
+                    metrics.count(masqDeviceId, EVENTS_MATCHED)
+                    self.updateDevice(self.masqueradeList[masqDeviceId], oldDevice, newDevice)
+                    break
+
+        # send everything this event produced, one server call per masquerade device
+        self.stateWriter.flush()
+        # charged to the base device, covering every masquerade it fans out to and the writes
+        metrics.observe(newDevice.id, "deviceUpdated", time.perf_counter_ns() - t0)
 
     ###############################################################################
 
     def updateDevice(self, masqDevice, oldDevice, newDevice):
-        if masqDevice.deviceTypeId == "masqSensor":
-            masqState = masqDevice.pluginProps["masqState"]
-            if oldDevice is None or oldDevice.states[masqState] != newDevice.states[masqState]:
-                matchString = masqDevice.pluginProps["matchString"]
-                reverse = bool(masqDevice.pluginProps["reverse"])
-                match = (str(newDevice.states[masqState]) == matchString)
-                if reverse:
-                    match = not match
-                self.logger.debug(f"updateDevice masqSensor: {newDevice.name} ({newDevice.states[masqState]}) -> {masqDevice.name} ({match})")
-
-                if masqDevice.pluginProps["masqSensorSubtype"] == "Generic":
-                    masqDevice.updateStateOnServer(key='onOffState', value=match)
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.NoImage)
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "MotionSensor":
-                    masqDevice.updateStateOnServer(key='onOffState', value=match)
-                    if match:
-                        masqDevice.updateStateImageOnServer(indigo.kStateImageSel.MotionSensorTripped)
-                    else:
-                        masqDevice.updateStateImageOnServer(indigo.kStateImageSel.MotionSensor)
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Power":
-                    masqDevice.updateStateOnServer(key='onOffState', value=match)
-                    if match:
-                        masqDevice.updateStateImageOnServer(indigo.kStateImageSel.PowerOn)
-                    else:
-                        masqDevice.updateStateImageOnServer(indigo.kStateImageSel.PowerOff)
-
+        # oldDevice is None for the initial sync.  Runs on the callback thread and the StartupSync thread.
+        plan = self.masqPlans.get(masqDevice.id)
+        lock = self.deviceLocks.get(masqDevice.id)
+        if plan is None or lock is None:
+            return
+        t0 = time.perf_counter_ns()
+        with lock:
+            handled = self.unsynced.get(masqDevice.id) if self.unsynced else None
+            if handled is not None:
+                # until the initial sync is done, the first update from each base device is the initial one.  The sync's
+                # own snapshot of a base device that has already sent an event is older than that event, so it's skipped.
+                if newDevice.id in handled:
+                    if oldDevice is None:
+                        return
                 else:
-                    self.logger.debug(f"updateDevice masqSensor, unknown subtype: {masqDevice.pluginProps['masqSensorSubtype']}")
-
-        elif masqDevice.deviceTypeId == "masqValueSensor":
-            masqState = masqDevice.pluginProps["masqState"]
-            if oldDevice is None or oldDevice.states[masqState] != newDevice.states[masqState]:
-                try:
-                    baseValue = float(newDevice.states[masqState])
-                except ValueError:
-                    self.logger.debug(f"{masqDevice.name}: Unable to convert state {masqState} = {newDevice.states[masqState]} to float")
-                    baseValue = 0
-                self.logger.debug(f"updateDevice masqValueSensor: {newDevice.name} ({baseValue}) -> {masqDevice.name} ({baseValue})")
-
-                if masqDevice.pluginProps["masqSensorSubtype"] == "Generic":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.NoImage)
-                    masqDevice.updateStateOnServer(key='sensorValue', value=baseValue)
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Temperature-F":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.TemperatureSensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value=baseValue, decimalPlaces=1, uiValue=str(baseValue) + u' °F')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Temperature-C":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.TemperatureSensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value=baseValue, decimalPlaces=1, uiValue=str(baseValue) + u' °C')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Humidity":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.HumiditySensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value=baseValue, decimalPlaces=0, uiValue=str(baseValue) + u'%')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Luminance":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.LightSensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value=baseValue, decimalPlaces=0, uiValue=str(baseValue) + u' lux')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Luminance%":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.LightSensor)
-                    masqDevice.updateStateOnServer(key='sensorValue', value=baseValue, decimalPlaces=0, uiValue=str(baseValue) + u'%')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "Energy":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.EnergyMeterOn)
-                    masqDevice.updateStateOnServer(key='sensorValue', value=baseValue, decimalPlaces=0, uiValue=str(baseValue) + u' watts')
-
-                elif masqDevice.pluginProps["masqSensorSubtype"] == "ppm":
-                    masqDevice.updateStateImageOnServer(indigo.kStateImageSel.NoImage)
-                    masqDevice.updateStateOnServer(key='sensorValue', value=baseValue, decimalPlaces=0, uiValue=str(baseValue) + u'ppm')
-
+                    handled.add(newDevice.id)
+                    oldDevice = None
+            plan.handler(masqDevice, plan, oldDevice, newDevice)
+        self.metrics.observe(masqDevice.id, "updateDevice", time.perf_counter_ns() - t0)
+
+    def updateSensor(self, masqDevice, plan, oldDevice, newDevice):
+        masqState = plan.masqState
+        if oldDevice is None or oldDevice.states[masqState] != newDevice.states[masqState]:
+            baseValue = newDevice.states[masqState]
+            match = (str(baseValue) == plan.matchString)
+            if plan.reverse:
+                match = not match
+            self.hotLog.debug("updateDevice masqSensor: %s (%s) -> %s (%s)", newDevice.name, baseValue, masqDevice.name, match)
+
+            self.stateWriter.setState(masqDevice, 'onOffState', match)
+            self.stateWriter.setImage(masqDevice, plan.onImage if match else plan.offImage)
+
+    def updateValueSensor(self, masqDevice, plan, oldDevice, newDevice):
+        masqState = plan.masqState
+        if oldDevice is None or oldDevice.states[masqState] != newDevice.states[masqState]:
+            smoother = self.smoothers.get(masqDevice.id)
+            try:
+                baseValue = float(newDevice.states[masqState])
+            except ValueError:
+                self.metrics.count(masqDevice.id, CONVERSION_FAILURES)
+                self.hotLog.debug("%s: Unable to convert state %s = %s to float", masqDevice.name, masqState, newDevice.states[masqState])
+                if smoother is not None:
+                    # keep a bad reading out of the window
+                    return
+                baseValue = 0
+            value = baseValue
+            if smoother is not None:
+                if oldDevice is None and smoother.restored and smoother.buffer.last()[1] == baseValue:
+                    # initial sync of a window restored from the warm state: the base device still has the last
+                    # reading it holds, so it isn't a new one
+                    smoother.restored = False
+                    value = smoother.evaluate()
                 else:
-                    self.logger.debug(f"updateDevice masqSensor, unknown subtype: {masqDevice.pluginProps['masqSensorSubtype']}")
-
-        elif masqDevice.deviceTypeId == "masqDimmer":
-            masqState = masqDevice.pluginProps["masqState"]
-            if oldDevice is None or oldDevice.states[masqState] != newDevice.states[masqState]:
-                baseValue = int(newDevice.states[masqState])
-                scaledValue = self.scaleBaseToMasq(masqDevice, baseValue)
-                self.logger.debug(f"updateDevice masqDimmer: {newDevice.name} ({baseValue}) -> {masqDevice.name} ({scaledValue})")
-                masqDevice.updateStateOnServer(key='brightnessLevel', value=scaledValue)
-
-        elif masqDevice.deviceTypeId == "masqSpeedControl":
-            if oldDevice is None or oldDevice.brightness != newDevice.brightness:
-                baseValue = newDevice.brightness
-                scaleFactor = int(masqDevice.pluginProps["scaleFactor"])
-                baseIndex = int(baseValue / scaleFactor)
-                self.logger.debug(f"updateDevice masqSpeedControl: {newDevice.name} ({baseValue}) --> {masqDevice.name} ({baseValue}, index {baseIndex})")
-                masqDevice.updateStateOnServer(key='speedLevel', value=baseValue)
-                masqDevice.updateStateOnServer(key='speedIndex', value=baseIndex)
-
-        elif masqDevice.deviceTypeId == "masqSprinkler":
-            if oldDevice is None or oldDevice.onState != newDevice.onState:
-                self.logger.debug(
-                    f"updateDevice masqSprinkler: {newDevice.name} ({newDevice.onState}) --> {masqDevice.name} ({newDevice.onState})")
-                masqDevice.updateStateOnServer(key='activeZone', value=(1 if newDevice.onState else 0))
+                    value = smoother.add(baseValue)
+                if plan.decimalPlaces is not None:
+                    value = round(value, plan.decimalPlaces)
+                smoother.output = value
+            self.hotLog.debug("updateDevice masqValueSensor: %s (%s) -> %s (%s)", newDevice.name, baseValue, masqDevice.name, value)
+            self.sendValue(masqDevice, plan, value, oldDevice is None)
+
+    def sendValue(self, masqDevice, plan, baseValue, initial):
+        # a value sensor reading goes through the rate limiter (if configured) to the state writer
+        if plan.throttled:
+            if initial:
+                self.throttle.sent(masqDevice.id, baseValue, time.monotonic())
+            elif not self.throttle.offer(masqDevice.id, baseValue, time.monotonic(),
+                                         plan.minUpdateInterval, plan.deadbandAbsolute, plan.deadbandPercent):
+                return
+        self.writeValueSensor(masqDevice, plan, baseValue)
+
+    def writeValueSensor(self, masqDevice, plan, baseValue):
+        if plan.uiSuffix is None:
+            self.stateWriter.setState(masqDevice, 'sensorValue', baseValue)
+        else:
+            self.stateWriter.setState(masqDevice, 'sensorValue', baseValue, uiValue=str(baseValue) + plan.uiSuffix, decimalPlaces=plan.decimalPlaces)
+        self.stateWriter.setImage(masqDevice, plan.image)
+        if plan.statsStates:
+            self.writeWindowStates(masqDevice)
+
+    def writeWindowStates(self, masqDevice):
+        smoother = self.smoothers.get(masqDevice.id)
+        if smoother is not None:
+            low, high, rate = smoother.statistics()
+            if low is not None:
+                self.stateWriter.setState(masqDevice, 'windowMin', low)
+                self.stateWriter.setState(masqDevice, 'windowMax', high)
+                self.stateWriter.setState(masqDevice, 'rateOfChange', round(rate, 3))
+
+    def refreshSmoothers(self):
+        # called from runConcurrentThread.  Indigo only sends deviceUpdated when a state changes, so a time window is
+        # moved along here to let the output settle on a value the base device is holding.
+        for deviceId, smoother in list(self.smoothers.items()):
+            if not smoother.moves():
+                continue
+            masqDevice = self.masqueradeList.get(deviceId)
+            plan = self.masqPlans.get(deviceId)
+            lock = self.deviceLocks.get(deviceId)
+            if masqDevice is None or plan is None or lock is None:
+                continue
+            with lock:
+                if self.smoothers.get(deviceId) is not smoother:
+                    continue    # recompiled in the meantime
+                value = smoother.evaluate()
+                if value is None:
+                    continue
+                if plan.decimalPlaces is not None:
+                    value = round(value, plan.decimalPlaces)
+                if value != smoother.output:
+                    # an unchanged value isn't offered again, it would only restart the rate limiter's interval
+                    smoother.output = value
+                    self.sendValue(masqDevice, plan, value, False)
+                if plan.statsStates:
+                    # even if the rate limiter held the value back
+                    self.writeWindowStates(masqDevice)
+
+    def emitThrottledValue(self, deviceId, baseValue):
+        # called from runConcurrentThread for a value the rate limiter held back
+        masqDevice = self.masqueradeList.get(deviceId)
+        plan = self.masqPlans.get(deviceId)
+        lock = self.deviceLocks.get(deviceId)
+        if masqDevice is None or plan is None or lock is None:
+            return
+        self.hotLog.debug("%s: sending held value %s", masqDevice.name, baseValue)
+        with lock:
+            self.writeValueSensor(masqDevice, plan, baseValue)
+
+    def updateDimmer(self, masqDevice, plan, oldDevice, newDevice):
+        masqState = plan.masqState
+        if oldDevice is None or oldDevice.states[masqState] != newDevice.states[masqState]:
+            baseValue = int(newDevice.states[masqState])
+            scaledValue = self.scaleBaseToMasq(masqDevice, plan, baseValue)
+            self.hotLog.debug("updateDevice masqDimmer: %s (%s) -> %s (%s)", newDevice.name, baseValue, masqDevice.name, scaledValue)
+            self.stateWriter.setState(masqDevice, 'brightnessLevel', scaledValue)
+            self.dispatcher.settle(plan.baseDevice, ("brightness", masqDevice.id), scaledValue)
+
+    def updateSpeedControl(self, masqDevice, plan, oldDevice, newDevice):
+        if oldDevice is None or oldDevice.brightness != newDevice.brightness:
+            baseValue = newDevice.brightness
+            baseIndex = int(baseValue / plan.scaleFactor)
+            self.hotLog.debug("updateDevice masqSpeedControl: %s (%s) --> %s (%s, index %s)", newDevice.name, baseValue, masqDevice.name, baseValue, baseIndex)
+            self.stateWriter.setState(masqDevice, 'speedLevel', baseValue)
+            self.stateWriter.setState(masqDevice, 'speedIndex', baseIndex)
+            self.dispatcher.settle(plan.baseDevice, ("speed", masqDevice.id), baseValue)
+
+    def updateSprinkler(self, masqDevice, plan, oldDevice, newDevice):
+        onState = newDevice.onState
+        if oldDevice is None or oldDevice.onState != onState:
+            self.hotLog.debug("updateDevice masqSprinkler: %s (%s) --> %s (%s)", newDevice.name, onState, masqDevice.name, onState)
+            self.stateWriter.setState(masqDevice, 'activeZone', (1 if onState else 0))
 
     ########################################
+    # Aggregate devices
+    ########################################
 
-    def actionControlDevice(self, action, dev):
+    def aggregateInput(self, masqDevice, plan, value):
+        # an input state as the Aggregator wants it, None if it can't be used
+        if value is None:
+            return None
+        if plan.aggFunction in ("any", "all"):
+            match = (str(value) == plan.matchString)
+            return not match if plan.reverse else match
+        if plan.aggFunction == "countTrue":
+            return truthy(value)
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            self.metrics.count(masqDevice.id, CONVERSION_FAILURES)
+            self.hotLog.debug("%s: Unable to convert input %s to float, leaving it out", masqDevice.name, value)
+            return None
 
-        if dev.pluginProps['masqAction'] == "---":
-            if action.deviceAction == indigo.kDeviceAction.TurnOn:
-                self.logger.debug(f"{dev.name}: actionControlDevice: Turn On")
-                indigo.device.turnOn(int(dev.pluginProps["baseDevice"]))
+    def updateAggregate(self, masqDevice, plan, oldDevice, newDevice):
+        # apply the inputs newDevice provides, returns (changed, aggregate value)
+        aggregate = self.aggregates.get(masqDevice.id)
+        if aggregate is None:
+            return False, None
+        newStates = newDevice.states
+        changed = False
+        result = None
+        for index, state in plan.inputIndex.get(newDevice.id, ()):
+            value = newStates.get(state)
+            if oldDevice is not None and oldDevice.states.get(state) == value:
+                continue
+            result = aggregate.set(index, self.aggregateInput(masqDevice, plan, value))
+            changed = True
+        return changed, result
+
+    def updateAggregateValue(self, masqDevice, plan, oldDevice, newDevice):
+        changed, result = self.updateAggregate(masqDevice, plan, oldDevice, newDevice)
+        if changed and result is not None:
+            self.writeAggregateValue(masqDevice, plan, result, oldDevice is None)
+
+    def writeAggregateValue(self, masqDevice, plan, result, initial):
+        if plan.decimalPlaces is not None:
+            result = round(result, plan.decimalPlaces)
+        self.hotLog.debug("updateDevice masqAggregateValue: %s of %d inputs -> %s (%s)", plan.aggFunction, len(plan.inputs), masqDevice.name, result)
+        self.sendValue(masqDevice, plan, result, initial)
+
+    def updateAggregateSensor(self, masqDevice, plan, oldDevice, newDevice):
+        changed, result = self.updateAggregate(masqDevice, plan, oldDevice, newDevice)
+        if changed and result is not None:
+            self.writeAggregateSensor(masqDevice, plan, result)
+
+    def writeAggregateSensor(self, masqDevice, plan, result):
+        self.hotLog.debug("updateDevice masqAggregateSensor: %s of %d inputs -> %s (%s)", plan.aggFunction, len(plan.inputs), masqDevice.name, result)
+        self.stateWriter.setState(masqDevice, 'onOffState', result)
+        self.stateWriter.setImage(masqDevice, plan.onImage if result else plan.offImage)
+
+    def removeAggregateInput(self, masqDevice, baseDeviceId):
+        plan = self.masqPlans.get(masqDevice.id)
+        aggregate = self.aggregates.get(masqDevice.id)
+        lock = self.deviceLocks.get(masqDevice.id)
+        if plan is None or aggregate is None or lock is None:
+            return
+        with lock:
+            for index, state in plan.inputIndex.get(baseDeviceId, ()):
+                aggregate.set(index, None)
+            result = aggregate.result()
+            if result is None:
+                return
+            if plan.deviceTypeId == "masqAggregateValue":
+                self.writeAggregateValue(masqDevice, plan, result, False)
+            else:
+                self.writeAggregateSensor(masqDevice, plan, result)
 
-            elif action.deviceAction == indigo.kDeviceAction.TurnOff:
-                self.logger.debug(f"{dev.name}: actionControlDevice: Turn Off")
-                indigo.device.turnOff(int(dev.pluginProps["baseDevice"]))
-            elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
+    ########################################
 
-                self.logger.debug(f"{dev.name}: actionControlDevice: Set Brightness to {action.actionValue}")
-                if action.actionValue > 0:
-                    indigo.device.turnOn(int(dev.pluginProps["baseDevice"]))
+    def actionControlDevice(self, action, dev):
+        t0 = time.perf_counter_ns()
+        plan = self.masqPlans.get(dev.id)
+        if plan is None:
+            self.logger.error(f"{dev.name}: actionControlDevice: Device is not configured correctly, ignoring {str(action)}")
+            return
+        if self.recorder is not None:
+            self.recorder.action("actionControlDevice", dev, action.deviceAction, action.actionValue)
+        deviceAction = action.deviceAction
+        actionValue = action.actionValue
+        actionString = str(action)
+        if deviceAction == indigo.kDeviceAction.SetBrightness:
+            # a newer brightness for this device replaces one that hasn't been sent yet
+            self.dispatcher.submitLatest(plan.baseDevice, ("brightness", dev.id), f"{dev.name}: actionControlDevice",
+                                         lambda value: self.runDeviceAction(dev, plan, deviceAction, value, actionString),
+                                         lambda pending: actionValue)
+        else:
+            self.dispatcher.submit(plan.baseDevice, f"{dev.name}: actionControlDevice", self.runDeviceAction,
+                                   dev, plan, deviceAction, actionValue, actionString)
+        self.metrics.observe(dev.id, "actionControlDevice", time.perf_counter_ns() - t0)
+
+    def runDeviceAction(self, dev, plan, deviceAction, actionValue, actionString):
+        # runs on an ActionDispatcher worker
+        if plan.masqAction == "---":
+            if deviceAction == indigo.kDeviceAction.TurnOn:
+                self.hotLog.debug("%s: actionControlDevice: Turn On", dev.name)
+                indigo.device.turnOn(plan.baseDevice)
+
+            elif deviceAction == indigo.kDeviceAction.TurnOff:
+                self.hotLog.debug("%s: actionControlDevice: Turn Off", dev.name)
+                indigo.device.turnOff(plan.baseDevice)
+            elif deviceAction == indigo.kDeviceAction.SetBrightness:
+
+                self.hotLog.debug("%s: actionControlDevice: Set Brightness to %s", dev.name, actionValue)
+                if actionValue > 0:
+                    indigo.device.turnOn(plan.baseDevice)
                 else:
-                    indigo.device.turnOff(int(dev.pluginProps["baseDevice"]))
+                    indigo.device.turnOff(plan.baseDevice)
 
             else:
-                self.logger.error(f"{dev.name}: actionControlDevice: Unsupported action requested: {str(action)}")
+                self.logger.error(f"{dev.name}: actionControlDevice: Unsupported action requested: {actionString}")
 
         else:
-            basePlugin = indigo.server.getPlugin(dev.pluginProps["devicePlugin"])
-            if basePlugin.isEnabled():
-                if action.deviceAction == indigo.kDeviceAction.TurnOn:
-                    self.logger.debug(f"{dev.name}: actionControlDevice: Turn On")
-                    if dev.pluginProps["masqValueField"]:
-                        props = {dev.pluginProps["masqValueField"]: dev.pluginProps["highLimitState"]}
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]), props=props)
+            basePlugin, enabled = self.pluginHandles.get(plan.devicePlugin)
+            if enabled:
+                if deviceAction == indigo.kDeviceAction.TurnOn:
+                    self.hotLog.debug("%s: actionControlDevice: Turn On", dev.name)
+                    if plan.masqValueField:
+                        props = {plan.masqValueField: str(plan.highLimitState)}
+                        basePlugin.executeAction(plan.masqAction, deviceId=plan.baseDevice, props=props)
                     else:
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]))
+                        basePlugin.executeAction(plan.masqAction, deviceId=plan.baseDevice)
 
-                elif action.deviceAction == indigo.kDeviceAction.TurnOff:
-                    self.logger.debug(f"{dev.name}: actionControlDevice: Turn Off")
-                    if dev.pluginProps["masqValueField"]:
-                        props = {dev.pluginProps["masqValueField"]: dev.pluginProps["lowLimitState"]}
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]), props=props)
+                elif deviceAction == indigo.kDeviceAction.TurnOff:
+                    self.hotLog.debug("%s: actionControlDevice: Turn Off", dev.name)
+                    if plan.masqValueField:
+                        props = {plan.masqValueField: str(plan.lowLimitState)}
+                        basePlugin.executeAction(plan.masqAction, deviceId=plan.baseDevice, props=props)
                     else:
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]))
+                        basePlugin.executeAction(plan.masqAction, deviceId=plan.baseDevice)
 
-                elif action.deviceAction == indigo.kDeviceAction.SetBrightness:
-                    if dev.pluginProps["masqValueField"]:
-                        scaledValueString = self.scaleMasqToBase(dev, action.actionValue)
-                        self.logger.debug(f"{dev.name}: actionControlDevice: Set Brightness to {action.actionValue} ({scaledValueString} scaled)")
-                        props = {dev.pluginProps["masqValueField"]: scaledValueString}
-                        basePlugin.executeAction(dev.pluginProps["masqAction"], deviceId=int(dev.pluginProps["baseDevice"]), props=props)
+                elif deviceAction == indigo.kDeviceAction.SetBrightness:
+                    if plan.masqValueField:
+                        scaledValueString = self.scaleMasqToBase(dev, plan, actionValue)
+                        self.hotLog.debug("%s: actionControlDevice: Set Brightness to %s (%s scaled)", dev.name, actionValue, scaledValueString)
+                        props = {plan.masqValueField: scaledValueString}
+                        basePlugin.executeAction(plan.masqAction, deviceId=plan.baseDevice, props=props)
 
                 else:
-                    self.logger.error(f"{dev.name}: actionControlDevice: Unsupported action requested: {str(action)}")
+                    self.logger.error(f"{dev.name}: actionControlDevice: Unsupported action requested: {actionString}")
             else:
-                self.logger.warning(f"actionControlDevice: Plugin for device {dev.name} is disabled.")
+                self.hotLog.warning(dev.id, "disabled", "actionControlDevice: Plugin for device %s is disabled.", dev.name)
 
     def actionControlSpeedControl(self, action, dev):
-        self.logger.debug(f"actionControlSpeedControl: '{dev.name}' action is {action}")
-        baseDevNum = int(dev.pluginProps["baseDevice"])
-        scaleFactor = int(dev.pluginProps["scaleFactor"])
-        if action.speedControlAction == indigo.kSpeedControlAction.TurnOn:
+        t0 = time.perf_counter_ns()
+        self.hotLog.debug("actionControlSpeedControl: '%s' action is %s", dev.name, action)
+        plan = self.masqPlans.get(dev.id)
+        if plan is None:
+            self.logger.error(f"actionControlSpeedControl: '{dev.name}' is not configured correctly, ignoring {action}")
+            return
+        if self.recorder is not None:
+            self.recorder.action("actionControlSpeedControl", dev, action.speedControlAction, action.actionValue)
+        speedControlAction = action.speedControlAction
+        actionValue = action.actionValue
+        scaleFactor = plan.scaleFactor
+        maxIndex = dev.speedIndexCount - 1
+        currentIndex = dev.speedIndex
+
+        # Speed changes are folded into the last speed asked for this device that the base device hasn't reported yet,
+        # whether it's still queued or already being sent.  fold() gets that level (or None) and returns the level to
+        # send, so relative steps build on the pending target.
+        if speedControlAction == indigo.kSpeedControlAction.SetSpeedIndex:
+            self.hotLog.debug("actionControlSpeedControl: '%s' Set Speed to %s", dev.name, actionValue)
+            fold = lambda pending: actionValue * scaleFactor
+        elif speedControlAction == indigo.kSpeedControlAction.SetSpeedLevel:
+            fold = lambda pending: actionValue
+        elif speedControlAction == indigo.kSpeedControlAction.IncreaseSpeedIndex:
+            fold = lambda pending: min((currentIndex if pending is None else int(pending / scaleFactor)) + 1, maxIndex) * scaleFactor
+        elif speedControlAction == indigo.kSpeedControlAction.DecreaseSpeedIndex:
+            fold = lambda pending: max((currentIndex if pending is None else int(pending / scaleFactor)) - 1, 0) * scaleFactor
+        else:
+            fold = None
+
+        if fold is not None:
+            self.dispatcher.submitLatest(plan.baseDevice, ("speed", dev.id), f"{dev.name}: actionControlSpeedControl",
+                                         lambda level: indigo.dimmer.setBrightness(plan.baseDevice, value=level), fold)
+        else:
+            self.dispatcher.submit(plan.baseDevice, f"{dev.name}: actionControlSpeedControl", self.runSpeedControlAction,
+                                   dev, plan, speedControlAction, str(action))
+        self.metrics.observe(dev.id, "actionControlSpeedControl", time.perf_counter_ns() - t0)
+
+    def runSpeedControlAction(self, dev, plan, speedControlAction, actionString):
+        # runs on an ActionDispatcher worker.  Speed changes are sent straight from actionControlSpeedControl.
+        baseDevNum = plan.baseDevice
+        if speedControlAction == indigo.kSpeedControlAction.TurnOn:
             indigo.device.turnOn(baseDevNum)
-        elif action.speedControlAction == indigo.kSpeedControlAction.TurnOff:
+        elif speedControlAction == indigo.kSpeedControlAction.TurnOff:
             indigo.device.turnOff(baseDevNum)
-        elif action.speedControlAction == indigo.kSpeedControlAction.Toggle:
+        elif speedControlAction == indigo.kSpeedControlAction.Toggle:
             indigo.device.toggle(baseDevNum)
-        elif action.speedControlAction == indigo.kSpeedControlAction.SetSpeedIndex:
-            self.logger.debug(f"actionControlSpeedControl: '{dev.name}' Set Speed to {action.actionValue}")
-            indigo.dimmer.setBrightness(baseDevNum, value=(action.actionValue * scaleFactor)) 
-        elif action.speedControlAction == indigo.kSpeedControlAction.SetSpeedLevel:
-            indigo.dimmer.setBrightness(baseDevNum, value=action.actionValue) 
-        elif action.speedControlAction == indigo.kSpeedControlAction.IncreaseSpeedIndex:
-            speedIndex = min(dev.speedIndex + 1, dev.speedIndexCount - 1)
-            indigo.dimmer.setBrightness(baseDevNum, value=(speedIndex * scaleFactor)) 
-        elif action.speedControlAction == indigo.kSpeedControlAction.DecreaseSpeedIndex:
-            speedIndex = max(dev.speedIndex - 1, 0)
-            indigo.dimmer.setBrightness(baseDevNum, value=(speedIndex * scaleFactor))
-        elif action.speedControlAction == indigo.kSpeedControlAction.RequestStatus:
+        elif speedControlAction == indigo.kSpeedControlAction.RequestStatus:
             indigo.device.statusRequest(baseDevNum)
         else:
-            self.logger.warn(f"Unsupported speed control action {action}")
+            self.hotLog.warning(dev.id, "unsupported", "Unsupported speed control action %s", actionString)
 
     def actionControlSprinkler(self, action, dev):
-        if action.sprinklerAction == indigo.kSprinklerAction.ZoneOn:
-            self.logger.debug(f"actionControlSprinkler: '{dev.name}' On")
-            indigo.device.turnOn(int(dev.pluginProps["baseDevice"]))
-        elif action.sprinklerAction == indigo.kSprinklerAction.AllZonesOff:
-            self.logger.debug(f"actionControlSprinkler: '{dev.name}' AllZonesOff")
-            indigo.device.turnOff(int(dev.pluginProps["baseDevice"]))
+        t0 = time.perf_counter_ns()
+        plan = self.masqPlans.get(dev.id)
+        if plan is None:
+            self.logger.error(f"actionControlSprinkler: '{dev.name}' is not configured correctly, ignoring {action}")
+            return
+        if self.recorder is not None:
+            self.recorder.action("actionControlSprinkler", dev, action.sprinklerAction, None)
+        self.dispatcher.submit(plan.baseDevice, f"{dev.name}: actionControlSprinkler", self.runSprinklerAction,
+                               dev, plan, action.sprinklerAction)
+        self.metrics.observe(dev.id, "actionControlSprinkler", time.perf_counter_ns() - t0)
+
+    def runSprinklerAction(self, dev, plan, sprinklerAction):
+        # runs on an ActionDispatcher worker
+        if sprinklerAction == indigo.kSprinklerAction.ZoneOn:
+            self.hotLog.debug("actionControlSprinkler: '%s' On", dev.name)
+            indigo.device.turnOn(plan.baseDevice)
+        elif sprinklerAction == indigo.kSprinklerAction.AllZonesOff:
+            self.hotLog.debug("actionControlSprinkler: '%s' AllZonesOff", dev.name)
+            indigo.device.turnOff(plan.baseDevice)
 
     ########################################################################
     # This method is called to generate a list of plugin identifiers / names
     ########################################################################
     def getPluginList(self, filter="", valuesDict=None, typeId="", targetId=0):
+        # Don't include self (i.e. this plugin) in the plugin list
+        return self.pluginCatalog.pluginMenu(self.pluginId)
 
-        retList = []
-        indigoInstallPath = indigo.server.getInstallFolderPath()
-        pluginFolders = ['Plugins', 'Plugins (Disabled)']
-        for pluginFolder in pluginFolders:
-            tempList = []
-            pluginsList = os.listdir(f"{indigoInstallPath}/{pluginFolder}")
-            for plugin in pluginsList:
-                # Check for Indigo Plugins and exclude 'system' plugins
-                if (plugin.lower().endswith('.indigoplugin')) and (not plugin[0:1] == '.'):
-                    # retrieve plugin Info.plist file
-                    path = f"{indigoInstallPath}/{pluginFolder}/{plugin}/Contents/Info.plist"
-                    with open(path, "rb") as fp:
-                        try:
-                            pl = plistlib.load(fp)
-                        except Exception as err:
-                            self.logger.warning(f"getPluginList: Unable to parse plist, skipping: {path}, err = {err}")
-                        else:
-                            self.logger.threaddebug(f"getPluginList: pl = {pl}")
-                            bundleId = pl["CFBundleIdentifier"]
-                            if self.pluginId != bundleId:
-                                # Don't include self (i.e. this plugin) in the plugin list
-                                displayName = pl["CFBundleDisplayName"]
-                                # if disabled plugins folder, append 'Disabled' to name
-                                if pluginFolder == 'Plugins (Disabled)':
-                                    displayName += ' [Disabled]'
-                                tempList.append((bundleId, displayName))
-            tempList.sort(key=lambda tup: tup[1])
-            retList = retList + tempList
-
-        return retList
-
-    @staticmethod
-    def getDevices(filter="", valuesDict=None, typeId="", targetId=0):
-        retList = []
+    def getDevices(self, filter="", valuesDict=None, typeId="", targetId=0):
         deviceClass = valuesDict.get("deviceClass", "plugin")
-        if deviceClass != "plugin":
-            for dev in indigo.devices.iter(deviceClass):
-                retList.append((dev.id, dev.name))
+        if deviceClass == "plugin":
+            return self.deviceDirectory.devicesForPlugin(valuesDict.get("devicePlugin", None))
+        elif deviceClass in DEVICE_CLASSES:
+            return self.deviceDirectory.devicesForClass(deviceClass)
         else:
-            devicePlugin = valuesDict.get("devicePlugin", None)
-            for dev in indigo.devices.iter():
-                if dev.protocol == indigo.kProtocol.Plugin and dev.pluginId == devicePlugin:
-                    for pluginId, pluginDict in dev.globalProps.iteritems():
-                        pass
-                    retList.append((dev.id, dev.name))
-
-        retList.sort(key=lambda tup: tup[1])
-        return retList
+            retList = [(dev.id, dev.name) for dev in indigo.devices.iter(deviceClass)]
+            retList.sort(key=lambda tup: tup[1])
+            return retList
 
-    @staticmethod
-    def getStateList(filter="", valuesDict=None, typeId="", targetId=0):
-        retList = []
+    def getStateList(self, filter="", valuesDict=None, typeId="", targetId=0):
         baseDeviceId = valuesDict.get("baseDevice", None)
         if not baseDeviceId:
-            return retList
+            return []
         try:
             baseDevice = indigo.devices[int(baseDeviceId)]
         except (Exception,):
-            return retList
-        for stateKey, stateValue in baseDevice.states.items():
-            retList.append((stateKey, stateKey))
-        retList.sort(key=lambda tup: tup[1])
+            return []
+        return self.deviceDirectory.stateList(baseDevice)
+
+    def getAggregateInputs(self, filter="", valuesDict=None, typeId="", targetId=0):
+        try:
+            inputs = parseInputs(valuesDict.get("aggInputs", ""))
+        except (TypeError, ValueError):
+            return []
+        retList = []
+        for baseId, state in inputs:
+            try:
+                name = indigo.devices[baseId].name
+            except KeyError:
+                name = f"Deleted device {baseId}"
+            retList.append((f"{baseId}:{state}", f"{name}: {state}"))
         return retList
 
+    def addAggregateInput(self, valuesDict, typeId, devId):
+        baseDevice = valuesDict.get("baseDevice", None)
+        state = valuesDict.get("masqState", None)
+        if not baseDevice or not state:
+            return valuesDict
+        try:
+            inputs = parseInputs(valuesDict.get("aggInputs", ""))
+        except (TypeError, ValueError):
+            inputs = []
+        entry = (int(baseDevice), state)
+        if entry not in inputs:
+            inputs.append(entry)
+        valuesDict["aggInputs"] = formatInputs(inputs)
+        return valuesDict
+
+    def removeAggregateInputs(self, valuesDict, typeId, devId):
+        selected = set(valuesDict.get("inputList", []))
+        try:
+            inputs = parseInputs(valuesDict.get("aggInputs", ""))
+        except (TypeError, ValueError):
+            inputs = []
+        valuesDict["aggInputs"] = formatInputs([(baseId, state) for baseId, state in inputs if f"{baseId}:{state}" not in selected])
+        return valuesDict
+
     def getActionList(self, filter="", valuesDict=None, typeId="", targetId=0):
-        retList = []
-        indigoInstallPath = indigo.server.getInstallFolderPath()
-        pluginsList = os.listdir(indigoInstallPath + '/Plugins')
-        for plugin in pluginsList:
-            if (plugin.lower().endswith('.indigoplugin')) and (not plugin[0:1] == '.'):
-                path = f"{indigoInstallPath}/Plugins/{plugin}/Contents/Info.plist"
-                with open(path, "rb") as fp:
-                    try:
-                        pl = plistlib.load(fp)
-                    except Exception as err:
-                        self.logger.warning(f"getPluginList: Unable to parse plist, skipping: {path}, err = {err}")
-                    else:
-                        bundleId = pl["CFBundleIdentifier"]
-                        if bundleId == valuesDict.get("devicePlugin", None):
-                            self.logger.debug(f"getActionList, checking  bundleId = {bundleId}")
-                            tree = ET.parse(f"{indigoInstallPath}/Plugins/{plugin}/Contents/Server Plugin/Actions.xml")
-                            actions = tree.getroot()
-                            for action in actions:
-                                if action.tag == "Action":
-                                    self.logger.debug(f"getActionList, Action attribs = {action.attrib}")
-                                    name = action.find('Name')
-                                    callBack = action.find('CallbackMethod')
-                                    if name is not None and callBack is not None:
-                                        self.logger.debug(f"getActionList, Action id = {action.attrib['id']}, name = '{name.text}', callBackMethod = {callBack.text}")
-                                        retList.append((action.attrib["id"], name.text))
-
-        retList.sort(key=lambda tup: tup[1])
+        retList = self.pluginCatalog.actionMenu(valuesDict.get("devicePlugin", None))
         retList.insert(0, ("---", "Standard Commands (On, Off, Brightness)"))
         return retList
 
     def getActionFieldList(self, filter="", valuesDict=None, typeId="", targetId=0):
-
-        retList = []
-        indigoInstallPath = indigo.server.getInstallFolderPath()
-        pluginsList = os.listdir(indigoInstallPath + '/Plugins')
-        for plugin in pluginsList:
-            if (plugin.lower().endswith('.indigoplugin')) and (not plugin[0:1] == '.'):
-                path = f"{indigoInstallPath}/Plugins/{plugin}/Contents/Info.plist"
-                with open(path, "rb") as fp:
-                    try:
-                        pl = plistlib.load(fp)
-                    except Exception as err:
-                        self.logger.warning(f"getPluginList: Unable to parse plist, skipping: {path}, err = {err}")
-                    else:
-                        bundleId = pl["CFBundleIdentifier"]
-                        if bundleId == valuesDict.get("devicePlugin", None):
-                            tree = ET.parse(f"{indigoInstallPath}/Plugins/{plugin}/Contents/Server Plugin/Actions.xml")
-                            actions = tree.getroot()
-                            if actions:
-                                for action in actions:
-                                    if action.tag == "Action" and action.attrib["id"] == valuesDict.get("masqAction", None):
-                                        configUI = action.find('ConfigUI')
-                                        for field in configUI:
-                                            self.logger.debug(f"ConfigUI List: child tag = {field.tag}, attrib = {field.attrib}")
-                                            if not bool(field.attrib.get("hidden", None)):
-                                                retList.append((field.attrib["id"], field.attrib["id"]))
-
-        retList.sort(key=lambda tup: tup[1])
+        retList = self.pluginCatalog.actionFieldMenu(valuesDict.get("devicePlugin", None), valuesDict.get("masqAction", None))
         if len(retList) == 0:
             retList.insert(0, ("---", "None"))
         return retList
@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Lookup-table scaling between a base device's value range and a masquerade dimmer's 0-100 level.
+#
+# A response curve maps the dimmer level (as a fraction 0..1) to a position in the base range (also
+# 0..1).  It's nondecreasing, so both directions come out monotonic:
+#
+#   linear      base = level
+#   gamma       base = level ** parameter                       (LED drivers, parameter around 2.2)
+#   log         base = (parameter ** level - 1) / (parameter - 1)   (exponential steps, parameter > 1)
+#   piecewise   straight lines between "level:base" breakpoints, both in percent, e.g. "0:0, 50:20, 100:100"
+#
+# MasqToBase precomputes the formatted base value for each of the 101 levels.  BaseToMasq precomputes
+# the level for each base value in the range, choosing the level whose base value is nearest, so
+# BaseToMasq(MasqToBase(level)) gives back level wherever the base range has room to tell levels apart,
+# and MasqToBase(BaseToMasq(value)) gives back value wherever some level maps to it.  Reverse reflects
+# the base range in both directions, which keeps that true for reversed devices.
+####################
+
+import bisect
+import math
+
+CURVES = ("linear", "gamma", "log", "piecewise")
+MAX_TABLE = 65536       # base ranges wider than this are looked up with bisect instead of a full table
+
+
+class ScaleError(ValueError):
+    pass
+
+
+def parseBreakpoints(text):
+    points = []
+    for item in text.replace(";", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            level, base = (float(part) for part in item.split(":"))
+        except ValueError:
+            raise ScaleError(f"invalid breakpoint '{item}', expected level:base")
+        points.append((level, base))
+    if len(points) < 2:
+        raise ScaleError("piecewise curve needs at least two breakpoints")
+    if points[0][0] != 0 or points[-1][0] != 100:
+        raise ScaleError("piecewise breakpoints must start at level 0 and end at level 100")
+    for (level1, base1), (level2, base2) in zip(points, points[1:]):
+        if level2 <= level1:
+            raise ScaleError(f"breakpoint levels must increase ({level1} then {level2})")
+        if base2 < base1:
+            raise ScaleError(f"breakpoint base values can't decrease ({base1} then {base2})")
+    for level, base in points:
+        if not 0 <= base <= 100:
+            raise ScaleError(f"breakpoint base value {base} is outside 0-100")
+    return points
+
+
+def makeCurve(kind, parameter=None, breakpoints=""):
+    """
+    Returns f(level fraction) -> base fraction for a curve type.  Raises ScaleError for bad settings.
+    """
+    if kind == "linear":
+        return lambda x: x
+
+    if kind == "gamma":
+        gamma = 2.2 if parameter in (None, "") else _number(parameter)
+        if gamma <= 0:
+            raise ScaleError(f"gamma must be positive, not {gamma}")
+        return lambda x: x ** gamma
+
+    if kind == "log":
+        steepness = 100.0 if parameter in (None, "") else _number(parameter)
+        if steepness <= 1:
+            raise ScaleError(f"log curve parameter must be greater than 1, not {steepness}")
+        return lambda x: (steepness ** x - 1.0) / (steepness - 1.0)
+
+    if kind == "piecewise":
+        points = parseBreakpoints(breakpoints or "")
+        levels = [level / 100.0 for level, base in points]
+        bases = [base / 100.0 for level, base in points]
+
+        def piecewise(x):
+            i = min(max(bisect.bisect_right(levels, x), 1), len(levels) - 1)
+            x1, x2 = levels[i - 1], levels[i]
+            return bases[i - 1] + (bases[i] - bases[i - 1]) * (x - x1) / (x2 - x1)
+        return piecewise
+
+    raise ScaleError(f"unknown scaling curve '{kind}'")
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ScaleError(f"invalid curve parameter '{value}'")
+    if math.isnan(number) or math.isinf(number):
+        raise ScaleError(f"invalid curve parameter '{value}'")
+    return number
+
+
+def _offsets(curve, span):
+    # (exact, rounded) offsets into a base range of width span for levels 0..100, both nondecreasing
+    exact = []
+    for level in range(101):
+        position = min(max(curve(level / 100.0), 0.0), 1.0)
+        if exact and position * span < exact[-1]:
+            position = exact[-1] / span     # guard against float wobble at flat spots
+        exact.append(position * span)
+    return exact, [int(math.floor(offset + 0.5)) for offset in exact]
+
+
+class MasqToBase(object):
+    """
+    Dimmer level (0-100) -> formatted base value string.
+    """
+    __slots__ = ("table",)
+
+    def __init__(self, curve, low, high, reverse, formatValue):
+        exact, rounded = _offsets(curve, abs(high - low))
+        step = 1 if high >= low else -1
+        start, sign = (high, -step) if reverse else (low, step)
+        self.table = tuple(formatValue(start + sign * offset) for offset in rounded)
+
+    def __call__(self, level):
+        return self.table[min(max(int(level), 0), 100)]
+
+
+class BaseToMasq(object):
+    """
+    Base value -> dimmer level (0-100).  The value should already be clamped to [minimum, maximum].
+    """
+    __slots__ = ("minimum", "maximum", "start", "sign", "exact", "rounded", "table")
+
+    def __init__(self, curve, low, high, reverse):
+        self.minimum = min(low, high)
+        self.maximum = max(low, high)
+        step = 1 if high >= low else -1
+        self.start, self.sign = (high, -step) if reverse else (low, step)
+        self.exact, self.rounded = _offsets(curve, abs(high - low))
+        span = self.maximum - self.minimum
+        if span < MAX_TABLE:
+            self.table = bytes(self.level(self.minimum + i) for i in range(span + 1))     # levels fit in a byte, 64 KB at most
+        else:
+            self.table = None
+
+    def level(self, value):
+        # the level whose base value is nearest value, used to build the table
+        offset = (value - self.start) * self.sign
+        rounded = self.rounded
+        first = bisect.bisect_left(rounded, offset)
+        last = bisect.bisect_right(rounded, offset) - 1
+        if first <= last:
+            # some levels land exactly on this value, take the one the curve puts closest
+            return min(max(self.fractional(offset), first), last)
+        if first == 0:
+            return 0
+        if first > 100:
+            return 100
+        below, above = rounded[first - 1], rounded[first]
+        if offset - below < above - offset:
+            return first - 1
+        if above - offset < offset - below:
+            return first
+        return min(max(self.fractional(offset), first - 1), first)
+
+    def fractional(self, offset):
+        # nearest whole level to where the curve reaches offset, by interpolating between levels
+        exact = self.exact
+        i = bisect.bisect_left(exact, offset)
+        if i == 0:
+            return 0
+        if i > 100:
+            return 100
+        below, above = exact[i - 1], exact[i]
+        if above == below:
+            return i
+        return int(math.floor(i - 1 + (offset - below) / (above - below) + 0.5))
+
+    def __call__(self, value):
+        if self.table is not None:
+            return self.table[int(value) - self.minimum]
+        return self.level(int(value))
@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Smoothing and window statistics for masqValueSensor readings.
+#
+# Each device keeps its recent readings in a RingBuffer: two array('d') columns (time, value), 16 bytes
+# per sample however long the plugin runs.  The window is the last N samples (256 if N isn't set), or
+# the samples from the last S seconds.  A time window's buffer starts small and doubles when it fills
+# with readings that are all still in the window, up to N if that's set, otherwise MAX_CAPACITY.
+#
+#   ema       exponential moving average, value = value + alpha * (reading - value)
+#   mean      time-weighted mean over the window, each reading counts for as long as it was current
+#             (Indigo only reports changes, so a reading holds until the next one)
+#   median    median of the readings in the window, kept in a sorted list that each reading is
+#             inserted into and removed from as it enters and leaves the window
+#
+# evaluate() gives the smoothed value at a later time without a new reading, so the window can be moved
+# along while the base device holds steady and Indigo sends no updates.  That is also how a new reading
+# gains weight in the mean, which it only has once it has been current for a while.
+####################
+
+import bisect
+import math
+import time
+from array import array
+
+SMOOTHING_MODES = ("none", "ema", "mean", "median")
+DEFAULT_CAPACITY = 256     # readings in a window when neither a count nor a time span is set
+MAX_CAPACITY = 4096         # most readings a time window keeps, 64 KB per device
+INITIAL_CAPACITY = 64
+
+
+class RingBuffer(object):
+    __slots__ = ("times", "values", "capacity", "limit", "start", "count")
+
+    def __init__(self, capacity, limit=None):
+        self.capacity = capacity
+        self.limit = capacity if limit is None else max(limit, capacity)     # capacity it may grow to
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, when, value):
+        # returns the value of the oldest sample if it was overwritten to make room, otherwise None
+        if self.count == self.capacity and self.capacity < self.limit:
+            self.grow(min(2 * self.capacity, self.limit))
+        capacity = self.capacity
+        i = self.start + self.count
+        if i >= capacity:
+            i -= capacity
+        evicted = None
+        if self.count == capacity:
+            evicted = self.values[i]
+            self.start = i + 1 if i + 1 < capacity else 0
+        else:
+            self.count += 1
+        self.times[i] = when
+        self.values[i] = value
+        return evicted
+
+    def grow(self, capacity):
+        # copy the samples, oldest first, into bigger columns
+        times = array('d', bytes(8 * capacity))
+        values = array('d', bytes(8 * capacity))
+        for i, (when, value) in enumerate(self.samples()):
+            times[i] = when
+            values[i] = value
+        self.times, self.values, self.capacity, self.start = times, values, capacity, 0
+
+    def expire(self, cutoff, removed=None):
+        # drop samples older than cutoff, but keep the one that was current at cutoff.  The values dropped
+        # are appended to removed if it's given.
+        times = self.times
+        capacity = self.capacity
+        while self.count > 1:
+            second = self.start + 1 if self.start + 1 < capacity else 0
+            if times[second] > cutoff:
+                break
+            if removed is not None:
+                removed.append(self.values[self.start])
+            self.start = second
+            self.count -= 1
+
+    def samples(self):
+        # (time, value) oldest first
+        times, values, capacity = self.times, self.values, self.capacity
+        i = self.start
+        for n in range(self.count):
+            yield times[i], values[i]
+            i += 1
+            if i == capacity:
+                i = 0
+
+    def first(self):
+        return self.times[self.start], self.values[self.start]
+
+    def last(self):
+        i = (self.start + self.count - 1) % self.capacity
+        return self.times[i], self.values[i]
+
+
+class Smoother(object):
+
+    def __init__(self, mode, alpha=0.3, samples=0, seconds=0.0, stats=False):
+        self.mode = mode
+        self.alpha = alpha
+        self.seconds = seconds
+        self.stats = stats          # window statistics are wanted
+        self.output = None          # last smoothed value passed on, as rounded by the caller
+        self.restored = False       # filled from the warm state and no reading added since
+        if seconds:
+            limit = samples or MAX_CAPACITY
+            self.buffer = RingBuffer(min(INITIAL_CAPACITY, limit), limit)
+        else:
+            self.buffer = RingBuffer(samples or DEFAULT_CAPACITY)
+        self.average = None         # ema state
+        self.ordered = [] if mode == "median" else None     # the window's values in order, for median
+
+    def add(self, value, now=None):
+        """
+        Record a reading and return the smoothed value.
+        """
+        now = time.time() if now is None else now
+        if math.isnan(value):
+            return self.evaluate(now)
+        if self.seconds:
+            # make room before appending, so the buffer only grows for readings still in the window
+            self.expire(now)
+        self.restored = False
+        evicted = self.buffer.append(now, value)
+        if self.ordered is not None:
+            if evicted is not None:
+                self.discard(evicted)
+            bisect.insort(self.ordered, value)
+        if self.mode == "ema":
+            self.average = value if self.average is None else self.average + self.alpha * (value - self.average)
+        return self.evaluate(now)
+
+    def evaluate(self, now=None):
+        """
+        The smoothed value at now (default the current time), None if there are no readings.
+        """
+        now = time.time() if now is None else now
+        buffer = self.buffer
+        if self.seconds:
+            self.expire(now)
+        if not buffer.count:
+            return None
+        mode = self.mode
+        if mode == "ema":
+            return self.average
+        if mode == "mean":
+            return self.timeWeightedMean(now)
+        if mode == "median":
+            ordered = self.ordered
+            middle = len(ordered) // 2
+            return ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2.0
+        return buffer.last()[1]
+
+    def expire(self, now):
+        if self.ordered is None:
+            self.buffer.expire(now - self.seconds)
+            return
+        removed = []
+        self.buffer.expire(now - self.seconds, removed)
+        for value in removed:
+            self.discard(value)
+
+    def discard(self, value):
+        # remove one copy of value from the ordered window
+        ordered = self.ordered
+        i = bisect.bisect_left(ordered, value)
+        if i < len(ordered) and ordered[i] == value:
+            del ordered[i]
+
+    def moves(self):
+        # True if the smoothed value or the window statistics can change with time alone: the mean as the
+        # latest reading gains weight, and a time window's median or statistics as readings leave it
+        if self.mode == "mean":
+            return True
+        return bool(self.seconds) and (self.mode == "median" or self.stats)
+
+    def saveState(self):
+        # JSON-able state for the warm-state snapshot
+        return {"samples": [[when, value] for when, value in self.buffer.samples()], "average": self.average}
+
+    def restoreState(self, state, now=None):
+        # refill the window from saveState(), dropping readings that have aged out of it since
+        buffer = self.buffer
+        cutoff = (time.time() if now is None else now) - self.seconds
+        for when, value in state.get("samples", ()):
+            if self.seconds:
+                buffer.expire(cutoff)
+            buffer.append(float(when), float(value))
+        if self.seconds and buffer.count:
+            buffer.expire(cutoff)
+        if self.ordered is not None:
+            self.ordered = sorted(value for when, value in buffer.samples())
+        self.restored = buffer.count > 0
+        average = state.get("average")
+        self.average = None if average is None else float(average)
+
+    def timeWeightedMean(self, now):
+        # each reading holds from its own time until the next one, the last one until now
+        start = now - self.seconds if self.seconds else None
+        total = 0.0
+        duration = 0.0
+        previous = None
+        for when, value in self.buffer.samples():
+            if previous is not None:
+                since = previous[0] if start is None else max(previous[0], start)
+                if when > since:
+                    total += previous[1] * (when - since)
+                    duration += when - since
+            previous = (when, value)
+        since = previous[0] if start is None else max(previous[0], start)
+        if now > since:
+            total += previous[1] * (now - since)
+            duration += now - since
+        return total / duration if duration > 0 else previous[1]
+
+    def statistics(self):
+        """
+        (window minimum, window maximum, rate of change per minute) of the readings in the window.
+        """
+        buffer = self.buffer
+        if not buffer.count:
+            return None, None, None
+        low = high = None
+        if self.ordered:
+            low, high = self.ordered[0], self.ordered[-1]
+        for when, value in (() if self.ordered else buffer.samples()):
+            if low is None or value < low:
+                low = value
+            if high is None or value > high:
+                high = value
+        firstTime, firstValue = buffer.first()
+        lastTime, lastValue = buffer.last()
+        rate = (lastValue - firstValue) * 60.0 / (lastTime - firstTime) if lastTime > firstTime else 0.0
+        return low, high, rate
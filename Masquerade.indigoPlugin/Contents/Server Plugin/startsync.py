@@ -0,0 +1,150 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Background initial sync for masquerade devices.
+#
+# deviceStartComm only registers a device and queues it here, so Indigo isn't held up while it starts
+# every device.  A worker thread takes the queued devices in batches, fetches each base device the
+# batch needs once (however many masquerades follow it), then syncs each masquerade.  A failure is
+# reported against the one device and the rest of the batch carries on.
+#
+# The time from start() until the queue first runs dry is logged as the startup time.
+####################
+
+import threading
+import time
+
+
+class StartupSync(object):
+
+    def __init__(self, logger, resolve, fetch, sync, flush, batchSize=100, settle=0.25):
+        self.logger = logger
+        self.resolve = resolve      # callable(device id) -> (device name, base device ids), or None if it's gone
+        self.fetch = fetch          # callable(base device id) -> base device, raises KeyError if it doesn't exist
+        self.sync = sync            # callable(device id, {base device id: base device}, missing base device ids) does the initial update
+        self.flush = flush          # callable() run after each batch
+        self.batchSize = batchSize
+        self.settle = settle        # seconds to let more devices arrive before starting a batch
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.queue = {}             # device id -> None, in arrival order, so a device is only queued once
+        self.running = False        # a batch is being processed
+        self.stopping = False
+        self.thread = None
+
+        self.started = None
+        self.startupTime = None     # seconds from start() to the first time everything queued was synced
+        self.synced = 0
+        self.fetched = 0
+        self.errors = 0
+        self.batches = 0
+
+    def start(self):
+        self.stopping = False
+        self.started = time.monotonic()
+        self.startupTime = None
+        self.thread = threading.Thread(target=self.work, name="StartupSync", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def add(self, deviceId):
+        with self.cond:
+            self.queue[deviceId] = None
+            self.cond.notify_all()
+
+    def discard(self, deviceId):
+        with self.cond:
+            self.queue.pop(deviceId, None)
+
+    @property
+    def pending(self):
+        return len(self.queue)
+
+    def wait(self, timeout=None):
+        """
+        Block until everything queued so far has been synced.  Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while self.queue or self.running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                full = len(self.queue) >= self.batchSize
+            if not full:
+                # give deviceStartComm a moment to queue the rest of a burst, so it's batched together
+                time.sleep(self.settle)
+            with self.cond:
+                if self.stopping:
+                    return
+                batch = []
+                for deviceId in self.queue:
+                    batch.append(deviceId)
+                    if len(batch) >= self.batchSize:
+                        break
+                for deviceId in batch:
+                    del self.queue[deviceId]
+                self.running = True
+
+            try:
+                self.runBatch(batch)
+            finally:
+                with self.cond:
+                    self.running = False
+                    done = not self.queue
+                    self.cond.notify_all()
+            if done and self.startupTime is None:
+                self.startupTime = time.monotonic() - self.started
+                self.logger.info(f"Startup sync complete: {self.synced} devices in {self.startupTime:.2f} s "
+                                 f"({self.fetched} base devices fetched, {self.errors} errors)")
+
+    def runBatch(self, batch):
+        bases = {}
+        missing = set()
+        for deviceId in batch:
+            name = deviceId
+            try:
+                resolved = self.resolve(deviceId)
+                if resolved is None:
+                    continue
+                name, baseIds = resolved
+                for baseId in baseIds:
+                    if baseId in bases or baseId in missing:
+                        continue
+                    try:
+                        bases[baseId] = self.fetch(baseId)
+                        self.fetched += 1
+                    except KeyError:
+                        missing.add(baseId)
+                found = {baseId: bases[baseId] for baseId in baseIds if baseId in bases}
+                absent = [baseId for baseId in baseIds if baseId in missing]
+                if absent:
+                    self.errors += 1
+                    self.logger.error(f"{name}: Base device {', '.join(str(baseId) for baseId in absent)} not found, "
+                                      f"{'continuing without it' if found else 'device will not be updated'}")
+                # called even with nothing found, so the device can let go of state it held for the missing bases
+                self.sync(deviceId, found, absent)
+                if found:
+                    self.synced += 1
+            except Exception as err:
+                self.errors += 1
+                self.logger.exception(f"{name}: Initial sync failed: {err}")
+        self.batches += 1
+        self.flush()
@@ -0,0 +1,127 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Batched state writes for masquerade devices.
+#
+# Update handlers queue state and image changes here instead of calling the server directly.  flush()
+# then sends each device's changes as a single updateStatesOnServer() call, followed by its image.
+#
+# The last value, uiValue and image written to each device are cached, and changes that match the
+# cache are dropped before they reach the server.
+#
+# flush() is called from several threads.  sendLock is held from taking the pending writes until they
+# have been sent, so one flush can't overtake another and land an older value after a newer one.
+####################
+
+import threading
+
+from metrics import WRITES
+
+
+class StateWriter(object):
+
+    def __init__(self, logger, metrics=None):
+        self.logger = logger
+        self.metrics = metrics  # MetricsRegistry, counts states written per device
+        self.lock = threading.Lock()          # pending writes and the cache
+        self.sendLock = threading.Lock()      # one flush at a time, so writes reach the server in order
+        self.pending = {}       # device id -> [device, {state key: key/value dict}, image or None]
+        self.written = {}       # device id -> {state key: (value, uiValue)}
+        self.images = {}        # device id -> image last written
+        self.serverCalls = 0
+        self.statesWritten = 0
+        self.statesSuppressed = 0
+        self.imagesSuppressed = 0
+
+    def seed(self, device):
+        # prime the cache with what the server already has for this device
+        states = device.states
+        cache = {}
+        for key, value in states.items():
+            if not key.endswith(".ui"):
+                cache[key] = (value, states.get(key + ".ui"))
+        with self.lock:
+            self.written[device.id] = cache
+            image = getattr(device, "displayStateImageSel", None)
+            if image is not None:
+                self.images[device.id] = image
+            else:
+                self.images.pop(device.id, None)
+
+    def forget(self, deviceId):
+        with self.lock:
+            self.pending.pop(deviceId, None)
+            self.written.pop(deviceId, None)
+            self.images.pop(deviceId, None)
+
+    def setState(self, device, key, value, uiValue=None, decimalPlaces=None):
+        update = {'key': key, 'value': value}
+        if uiValue is not None:
+            update['uiValue'] = uiValue
+        if decimalPlaces is not None:
+            update['decimalPlaces'] = decimalPlaces
+        with self.lock:
+            entry = self.pending.get(device.id)
+            if entry is None:
+                entry = self.pending[device.id] = [device, {}, None]
+            entry[0] = device
+            entry[1][key] = update
+
+    def setImage(self, device, image):
+        with self.lock:
+            entry = self.pending.get(device.id)
+            if entry is None:
+                entry = self.pending[device.id] = [device, {}, None]
+            entry[0] = device
+            entry[2] = image
+
+    def flush(self):
+        with self.sendLock:
+            self.send(self.collect())
+
+    def collect(self):
+        # take the pending writes that differ from the cache, as (device, changed states, image or None)
+        with self.lock:
+            if not self.pending:
+                return []
+            writes = []
+            for deviceId, (device, updates, image) in self.pending.items():
+                cache = self.written.setdefault(deviceId, {})
+                changed = []
+                for key, update in updates.items():
+                    uiValue = update.get('uiValue')
+                    last = cache.get(key)
+                    if last is not None and last[0] == update['value'] and (uiValue is None or last[1] == uiValue):
+                        self.statesSuppressed += 1
+                        continue
+                    cache[key] = (update['value'], uiValue)
+                    changed.append(update)
+                if image is not None:
+                    if self.images.get(deviceId) == image:
+                        self.imagesSuppressed += 1
+                        image = None
+                    else:
+                        self.images[deviceId] = image
+                if changed or image is not None:
+                    writes.append((device, changed, image))
+            self.pending = {}
+        return writes
+
+    def send(self, writes):
+        for device, changed, image in writes:
+            try:
+                if changed:
+                    device.updateStatesOnServer(changed)
+                    self.serverCalls += 1
+                    self.statesWritten += len(changed)
+                    if self.metrics is not None:
+                        self.metrics.count(device.id, WRITES, len(changed))
+                if image is not None:
+                    device.updateStateImageOnServer(image)
+                    self.serverCalls += 1
+            except Exception as err:
+                self.logger.error(f"{device.name}: Error writing states {[update['key'] for update in changed]}: {err}")
+                # we don't know what the server has now, so don't suppress the next write
+                with self.lock:
+                    self.written.pop(device.id, None)
+                    self.images.pop(device.id, None)
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Rate limiting and deadband filtering for masquerade value updates.
+#
+# offer() decides whether a new value goes out now, is held back until the device's minimum update
+# interval has passed, or is dropped because it's inside the deadband around the last value sent.
+# Held values are latest-wins, so a burst collapses into one write, and runDue() (called from the
+# plugin's runConcurrentThread) sends the final value of the burst once its interval is up.
+####################
+
+import threading
+
+
+class UpdateThrottle(object):
+
+    def __init__(self, emit):
+        self.emit = emit            # callable(deviceId, value) that writes a value out
+        self.lock = threading.Lock()
+        self.wakeEvent = threading.Event()
+        self.lastSent = {}          # device id -> (time sent, value sent)
+        self.pending = {}           # device id -> (time due, value)
+        self.coalesced = 0
+        self.deadbanded = 0
+
+    @staticmethod
+    def inDeadband(value, lastValue, absolute, percent):
+        delta = abs(value - lastValue)
+        if absolute and delta < absolute:
+            return True
+        if percent and delta < abs(lastValue) * percent / 100.0:
+            return True
+        return False
+
+    def offer(self, deviceId, value, now, interval, absolute, percent):
+        """
+        Returns True if value should be written now.  Otherwise it's either held for runDue() or dropped.
+        """
+        with self.lock:
+            last = self.lastSent.get(deviceId)
+            if last is None:
+                self.lastSent[deviceId] = (now, value)
+                return True
+
+            lastTime, lastValue = last
+            if self.inDeadband(value, lastValue, absolute, percent):
+                # back inside the band, anything still held is stale
+                self.pending.pop(deviceId, None)
+                self.deadbanded += 1
+                return False
+
+            due = lastTime + interval
+            if now >= due:
+                self.pending.pop(deviceId, None)
+                self.lastSent[deviceId] = (now, value)
+                return True
+
+            if deviceId in self.pending:
+                self.coalesced += 1
+            self.pending[deviceId] = (due, value)
+
+        self.wakeEvent.set()
+        return False
+
+    def sent(self, deviceId, value, now):
+        # record a write that bypassed offer(), such as the initial sync at device start
+        with self.lock:
+            self.pending.pop(deviceId, None)
+            self.lastSent[deviceId] = (now, value)
+
+    def forget(self, deviceId):
+        with self.lock:
+            self.pending.pop(deviceId, None)
+            self.lastSent.pop(deviceId, None)
+
+    def runDue(self, now):
+        """
+        Emit every held value whose interval is up.  Returns the seconds until the next one is due, or None.
+        """
+        self.wakeEvent.clear()
+        ready = []
+        nextDue = None
+        with self.lock:
+            for deviceId, (due, value) in list(self.pending.items()):
+                if due <= now:
+                    del self.pending[deviceId]
+                    self.lastSent[deviceId] = (now, value)
+                    ready.append((deviceId, value))
+                elif nextDue is None or due < nextDue:
+                    nextDue = due
+
+        for deviceId, value in ready:
+            self.emit(deviceId, value)
+
+        return None if nextDue is None else nextDue - now
+
+    def wait(self, timeout):
+        # sleep until timeout or until a new value is held back
+        self.wakeEvent.wait(timeout)
+
+    def wakeup(self):
+        self.wakeEvent.set()
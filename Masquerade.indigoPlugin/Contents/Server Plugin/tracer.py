@@ -0,0 +1,116 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Capture of the device events and actions the plugin receives, for replay in load tests.
+#
+# Traces are JSON lines, append only, one record per line:
+#   {"t": time, "e": "masq", "id": ..., "name": ..., "type": deviceTypeId, "props": {...}}   masquerade device config
+#   {"t": time, "e": "dev", "id": ..., "name": ..., "plugin": ..., "protocol": ..., "states": {...}}  first sighting of a device
+#   {"t": time, "e": "u", "id": ..., "s": {changed state: new value}}                        deviceUpdated
+#   {"t": time, "e": "d", "id": ...}                                                           deviceDeleted
+#   {"t": time, "e": "a", "fn": actionControl method, "id": ..., "a": action, "v": actionValue}
+#
+# Each file starts with the masquerade devices and their base devices, so every file (including the
+# ones left behind by rotation) can be replayed on its own.
+####################
+
+import json
+import os
+import threading
+import time
+
+
+class EventRecorder(object):
+
+    def __init__(self, logger, path, maxBytes, backupCount=3, header=None):
+        self.logger = logger
+        self.path = path
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.header = header        # callable returning the records each file starts with
+        self.lock = threading.Lock()
+        self.fp = None
+        self.size = 0
+        self.seen = set()           # device ids with a "dev" record in the current file
+        self.records = 0
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fp = open(self.path, "a", encoding="utf-8")
+        self.size = self.fp.tell()
+        self.seen = set()
+        if self.header is not None:
+            for record in self.header():
+                self.write(record)
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+    def flush(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.flush()
+
+    def rotate(self):
+        self.fp.close()
+        for i in range(self.backupCount - 1, 0, -1):
+            older = f"{self.path}.{i}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{i + 1}")
+        if self.backupCount > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, record):
+        # caller holds the lock (or is open())
+        line = json.dumps(record, separators=(",", ":"), default=str) + "\n"
+        self.fp.write(line)
+        self.size += len(line)
+        self.records += 1
+        if record["e"] == "dev":
+            self.seen.add(record["id"])
+
+    def emit(self, record):
+        with self.lock:
+            if self.fp is None:
+                return
+            try:
+                self.write(record)
+                if self.size >= self.maxBytes:
+                    self.rotate()
+            except (OSError, ValueError) as err:
+                self.logger.error(f"Event trace write to {self.path} failed, tracing stopped: {err}")
+                self.fp = None
+
+    ########################################
+
+    @staticmethod
+    def deviceRecord(dev, now=None):
+        return {"t": round(now or time.time(), 3), "e": "dev", "id": dev.id, "name": dev.name, "type": dev.deviceTypeId,
+                "plugin": dev.pluginId, "protocol": str(dev.protocol), "states": dict(dev.states)}
+
+    @staticmethod
+    def masqueradeRecord(dev, now=None):
+        return {"t": round(now or time.time(), 3), "e": "masq", "id": dev.id, "name": dev.name, "type": dev.deviceTypeId,
+                "props": dict(dev.pluginProps)}
+
+    def deviceUpdated(self, oldDevice, newDevice):
+        now = time.time()
+        if newDevice.id not in self.seen:
+            self.emit(self.deviceRecord(newDevice, now))
+            return
+        oldStates = oldDevice.states
+        changed = {key: value for key, value in newDevice.states.items() if oldStates.get(key) != value}
+        if changed:
+            self.emit({"t": round(now, 3), "e": "u", "id": newDevice.id, "s": changed})
+
+    def deviceDeleted(self, dev):
+        self.emit({"t": round(time.time(), 3), "e": "d", "id": dev.id})
+
+    def action(self, method, dev, action, actionValue):
+        self.emit({"t": round(time.time(), 3), "e": "a", "fn": method, "id": dev.id, "a": str(action), "v": actionValue})
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Warm-state snapshot: masquerade runtime state that has to survive a plugin restart.
+#
+# Indigo keeps each device's states, and the state writer seeds its cache from them, so restarts
+# already only write values that changed.  What a restart loses is the state behind those values:
+# smoothing windows and aggregate inputs.  That is saved here as one JSON file, written to a temporary
+# file and renamed, so a crash part way through a save leaves the previous snapshot in place.
+#
+# Each device record has the devVersCount the device had when it was saved, and each part of the
+# record has the settings it depends on ("config"), so it's only restored into a device set up the
+# same way.
+####################
+
+import json
+import os
+import time
+
+FORMAT = 1      # file layout version, a snapshot in any other layout is ignored
+
+
+class WarmStateStore(object):
+
+    def __init__(self, logger, path):
+        self.logger = logger
+        self.path = path
+        self.loaded = 0
+        self.saves = 0
+        self.lastSave = None
+
+    def load(self):
+        """
+        Returns {device id: record} from the last snapshot, or {} if there isn't a usable one.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            self.logger.warning(f"Unable to read warm state {self.path}, starting cold: {err}")
+            return {}
+        if not isinstance(data, dict) or data.get("format") != FORMAT or not isinstance(data.get("devices"), dict):
+            self.logger.warning(f"Warm state {self.path} is not in a format this version understands, starting cold")
+            return {}
+
+        records = {}
+        for deviceId, record in data["devices"].items():
+            try:
+                records[int(deviceId)] = record
+            except ValueError:
+                continue
+        self.loaded = len(records)
+        self.logger.debug(f"Loaded warm state for {len(records)} devices, saved {time.ctime(data.get('saved', 0))}")
+        return records
+
+    def save(self, records):
+        # records: {device id: record}, each record JSON-able
+        data = {"format": FORMAT, "saved": time.time(), "devices": {str(deviceId): record for deviceId, record in records.items()}}
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w", encoding="utf-8") as fp:
+                json.dump(data, fp, separators=(",", ":"))
+            os.replace(self.path + ".tmp", self.path)
+        except (OSError, ValueError) as err:
+            self.logger.error(f"Unable to write warm state {self.path}: {err}")
+            return False
+        self.saves += 1
+        self.lastSave = time.time()
+        return True
@@ -0,0 +1,240 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Offline benchmarks for the Masquerade plugin's event and action hot paths.
+#
+#   python benchmarks/bench_plugin.py                          # default sizes, JSON to stdout
+#   python benchmarks/bench_plugin.py -m 10 100 1000 5000 -o bench.json
+#   python benchmarks/bench_plugin.py -o new.json --compare old.json
+#
+# Runs plugin.py unchanged against fake_indigo.  For each inventory size it reports events/sec,
+# p50/p99 latency, server calls per event and allocations for deviceUpdated, and the same for
+# action storms through actionControlDevice/actionControlSpeedControl.
+####################
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_indigo as indigo  # noqa: E402
+import harness  # noqa: E402
+
+
+def percentile(sortedValues, pct):
+    if not sortedValues:
+        return 0.0
+    index = min(len(sortedValues) - 1, int(round(pct / 100.0 * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+
+def latencyStats(samples):
+    samples = sorted(samples)
+    return {
+        "p50_us": round(percentile(samples, 50) / 1000.0, 2),
+        "p99_us": round(percentile(samples, 99) / 1000.0, 2),
+        "max_us": round(samples[-1] / 1000.0, 2) if samples else 0.0,
+    }
+
+
+def serverCalls():
+    return sum(count for name, count in indigo.calls.items() if name != "devices[]")
+
+
+########################################
+
+def benchEvents(plugin, baseIds, events, rate, seed):
+    """
+    Drive `events` random base-device changes through deviceUpdated.  rate is events/sec, 0 for as fast as possible.
+    """
+    rng = random.Random(seed)
+    bases = [indigo.devices[baseId] for baseId in baseIds]
+    indigo.resetCalls()
+    samples = []
+    interval = 1.0 / rate if rate else 0.0
+    started = time.perf_counter()
+    nextEvent = started
+    for i in range(events):
+        if interval:
+            delay = nextEvent - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            nextEvent += interval
+        old, new = harness.mutate(rng.choice(bases), rng)
+        t0 = time.perf_counter_ns()
+        plugin.deviceUpdated(old, new)
+        samples.append(time.perf_counter_ns() - t0)
+    elapsed = time.perf_counter() - started
+    calls = serverCalls()
+
+    result = {"events": events, "elapsed_s": round(elapsed, 4),
+              "events_per_s": round(events / sum(samples) * 1e9, 1) if sum(samples) else 0.0,
+              "server_calls": calls, "server_calls_per_event": round(calls / events, 4) if events else 0.0,
+              "calls_by_name": dict(indigo.calls)}
+    result.update(latencyStats(samples))
+    return result
+
+
+def benchEventAllocations(plugin, baseIds, events, seed):
+    rng = random.Random(seed)
+    bases = [indigo.devices[baseId] for baseId in baseIds]
+    changes = [harness.mutate(rng.choice(bases), rng) for i in range(events)]
+    tracemalloc.start()
+    before = sys.getallocatedblocks()
+    tracemalloc.reset_peak()
+    start, _ = tracemalloc.get_traced_memory()
+    for old, new in changes:
+        plugin.deviceUpdated(old, new)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"alloc_peak_bytes": peak - start, "alloc_retained_bytes": current - start,
+            "alloc_retained_blocks": sys.getallocatedblocks() - before}
+
+
+def benchActions(plugin, masqDevices, actions, seed):
+    """
+    An action storm: random on/off/brightness/speed commands against dimmer and speed control masquerades.
+    Measures the time each actionControl* call holds the caller, then the time to drain the queued work.
+    """
+    rng = random.Random(seed)
+    dimmers = [dev for dev in masqDevices if dev.deviceTypeId == "masqDimmer"]
+    fans = [dev for dev in masqDevices if dev.deviceTypeId == "masqSpeedControl"]
+    if not dimmers and not fans:
+        return None
+    indigo.resetCalls()
+    samples = []
+    started = time.perf_counter()
+    for i in range(actions):
+        if fans and (not dimmers or rng.random() < 0.3):
+            dev = rng.choice(fans)
+            which = rng.randrange(4)
+            if which == 0:
+                action = harness.Action(speedControlAction=indigo.kSpeedControlAction.SetSpeedIndex, actionValue=rng.randint(0, 3))
+            elif which == 1:
+                action = harness.Action(speedControlAction=indigo.kSpeedControlAction.SetSpeedLevel, actionValue=rng.randint(0, 100))
+            elif which == 2:
+                action = harness.Action(speedControlAction=indigo.kSpeedControlAction.IncreaseSpeedIndex)
+            else:
+                action = harness.Action(speedControlAction=indigo.kSpeedControlAction.TurnOff)
+            t0 = time.perf_counter_ns()
+            plugin.actionControlSpeedControl(action, dev)
+        else:
+            dev = rng.choice(dimmers)
+            which = rng.randrange(4)
+            if which < 2:
+                action = harness.Action(deviceAction=indigo.kDeviceAction.SetBrightness, actionValue=rng.randint(0, 100))
+            elif which == 2:
+                action = harness.Action(deviceAction=indigo.kDeviceAction.TurnOn)
+            else:
+                action = harness.Action(deviceAction=indigo.kDeviceAction.TurnOff)
+            t0 = time.perf_counter_ns()
+            plugin.actionControlDevice(action, dev)
+        samples.append(time.perf_counter_ns() - t0)
+    submitted = time.perf_counter() - started
+
+    dispatcher = getattr(plugin, "dispatcher", None)
+    if dispatcher is not None:
+        dispatcher.drain(60.0)
+    elapsed = time.perf_counter() - started
+    calls = serverCalls()
+
+    result = {"actions": actions, "submit_s": round(submitted, 4), "elapsed_s": round(elapsed, 4),
+              "actions_per_s": round(actions / elapsed, 1) if elapsed else 0.0,
+              "server_calls": calls, "server_calls_per_action": round(calls / actions, 4) if actions else 0.0,
+              "calls_by_name": dict(indigo.calls)}
+    result.update(latencyStats(samples))
+    return result
+
+
+def runScenario(masquerades, bases, events, actions, rate, actionDelay, seed, types=harness.DEVICE_TYPES):
+    baseIds, masqDevices = harness.buildDatabase(masquerades, bases, seed=seed, types=types)
+    plugin = harness.loadPlugin()
+    indigo.resetCalls()
+
+    t0 = time.perf_counter()
+    harness.startPlugin(plugin, masqDevices)
+    startup = time.perf_counter() - t0
+    startupCalls = serverCalls()
+
+    result = {"masquerades": masquerades, "bases": bases,
+              "startup": {"elapsed_s": round(startup, 4), "server_calls": startupCalls,
+                          "sync_s": getattr(getattr(plugin, "startupSync", None), "startupTime", None)},
+              "events": benchEvents(plugin, baseIds, events, rate, seed)}
+    result["events"].update(benchEventAllocations(plugin, baseIds, min(events, 2000), seed + 1))
+
+    indigo._PluginInfo.actionDelay = actionDelay
+    try:
+        result["actions"] = benchActions(plugin, masqDevices, actions, seed)
+    finally:
+        indigo._PluginInfo.actionDelay = 0.0
+
+    harness.stopPlugin(plugin, masqDevices)
+    return result
+
+
+########################################
+
+COMPARE_KEYS = (("events", "events_per_s", True), ("events", "p50_us", False), ("events", "p99_us", False),
+                ("events", "server_calls_per_event", False), ("actions", "p99_us", False),
+                ("actions", "actions_per_s", True), ("startup", "elapsed_s", False))
+
+
+def compare(current, baseline, out):
+    old = {run["masquerades"]: run for run in baseline.get("runs", [])}
+    for run in current["runs"]:
+        prev = old.get(run["masquerades"])
+        if prev is None:
+            continue
+        for section, key, higherIsBetter in COMPARE_KEYS:
+            new, was = (run.get(section) or {}).get(key), (prev.get(section) or {}).get(key)
+            if new is None or not was:
+                continue
+            change = (new - was) / was * 100.0
+            worse = change < 0 if higherIsBetter else change > 0
+            flag = "  <-- regression" if worse and abs(change) > 10.0 else ""
+            out.write(f"{run['masquerades']:>6} {section}.{key:<24} {was:>12} -> {new:>12} ({change:+.1f}%){flag}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-m", "--masquerades", type=int, nargs="+", default=[10, 100, 1000, 5000],
+                        help="masquerade inventory sizes to run")
+    parser.add_argument("-b", "--bases", type=int, default=2000, help="number of base devices")
+    parser.add_argument("-e", "--events", type=int, default=20000, help="deviceUpdated events per size")
+    parser.add_argument("-a", "--actions", type=int, default=5000, help="actions per size")
+    parser.add_argument("-r", "--rate", type=float, default=0.0, help="events per second, 0 for as fast as possible")
+    parser.add_argument("--action-delay", type=float, default=0.0, help="seconds each base plugin executeAction() takes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-t", "--types", nargs="+", default=list(harness.DEVICE_TYPES),
+                        help=f"masquerade device types to spread the inventory over (aggregates: {' '.join(harness.AGGREGATE_TYPES)})")
+    parser.add_argument("-o", "--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--compare", help="baseline JSON results to compare against")
+    args = parser.parse_args(argv)
+
+    results = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "args": vars(args)},
+        "runs": [runScenario(size, args.bases, args.events, args.actions, args.rate, args.action_delay, args.seed, tuple(args.types))
+                 for size in args.masquerades],
+    }
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(results, json.load(fp), sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
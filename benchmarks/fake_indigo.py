@@ -0,0 +1,301 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Stand-in for the `indigo` module, so plugin.py can run without an IndigoServer.
+#
+# Only the parts of the API the plugin uses are provided.  Every call that would be an IPC round trip
+# to the server is counted in `calls` (name -> count), and device objects keep the states written to
+# them so results can be checked.  Set `writeLog` to a list to capture the writes themselves.
+####################
+
+import copy
+import logging
+import threading
+import time
+from collections import Counter
+
+calls = Counter()
+callsLock = threading.Lock()
+writeLog = None         # set to a list to also collect (device id, key/value list, image) for every state write
+
+
+def record(name):
+    with callsLock:
+        calls[name] += 1
+
+
+def resetCalls():
+    with callsLock:
+        calls.clear()
+
+
+class _Enum(object):
+    def __init__(self, name, *values):
+        for value in values:
+            setattr(self, value, f"{name}.{value}")
+
+
+kStateImageSel = _Enum("kStateImageSel", "Auto", "NoImage", "SensorOff", "SensorOn", "SensorTripped", "MotionSensor",
+                       "MotionSensorTripped", "PowerOff", "PowerOn", "TemperatureSensor", "TemperatureSensorOn",
+                       "HumiditySensor", "HumiditySensorOn", "LightSensor", "LightSensorOn", "EnergyMeterOff", "EnergyMeterOn")
+kDeviceAction = _Enum("kDeviceAction", "TurnOn", "TurnOff", "Toggle", "SetBrightness", "BrightenBy", "DimBy",
+                      "Lock", "Unlock", "RequestStatus", "AllLightsOn", "AllLightsOff", "AllOff")
+kSpeedControlAction = _Enum("kSpeedControlAction", "TurnOn", "TurnOff", "Toggle", "SetSpeedIndex", "SetSpeedLevel",
+                            "IncreaseSpeedIndex", "DecreaseSpeedIndex", "RequestStatus")
+kSprinklerAction = _Enum("kSprinklerAction", "ZoneOn", "AllZonesOff", "RequestStatus")
+kProtocol = _Enum("kProtocol", "Insteon", "X10", "ZWave", "Plugin")
+
+
+class Dict(dict):
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+########################################
+# devices
+
+class Device(object):
+    """
+    A device as seen by a plugin.  brightness, onState and speedIndex are derived from states the way
+    the real dimmer/relay/speed control classes do.
+    """
+
+    def __init__(self, id, name, deviceTypeId="", pluginId="", protocol=kProtocol.Plugin, states=None, pluginProps=None,
+                 deviceClass="device", enabled=True):
+        self.id = id
+        self.name = name
+        self.deviceTypeId = deviceTypeId
+        self.pluginId = pluginId
+        self.protocol = protocol
+        self.states = Dict(states or {})
+        self.pluginProps = Dict(pluginProps or {})
+        self.globalProps = Dict({pluginId: self.pluginProps}) if pluginId else Dict()
+        self.deviceClass = deviceClass
+        self.enabled = enabled
+        self.displayStateImageSel = kStateImageSel.Auto
+        self.speedIndexCount = 4
+
+    def __repr__(self):
+        return f"Device({self.id}, {self.name!r})"
+
+    def __str__(self):
+        return f"name : {self.name}\nid : {self.id}\nstates : {dict(self.states)}"
+
+    @property
+    def brightness(self):
+        return self.states.get("brightnessLevel", 0)
+
+    @property
+    def onState(self):
+        return self.states.get("onOffState", False)
+
+    @property
+    def speedIndex(self):
+        return self.states.get("speedIndex", 0)
+
+    @property
+    def speedLevel(self):
+        return self.states.get("speedLevel", 0)
+
+    @property
+    def sensorValue(self):
+        return self.states.get("sensorValue")
+
+    def copy(self):
+        dup = copy.copy(self)
+        dup.states = Dict(self.states)
+        dup.pluginProps = Dict(self.pluginProps)
+        return dup
+
+    # server calls
+
+    def updateStateOnServer(self, key, value, uiValue=None, decimalPlaces=None, clearErrorState=True):
+        record("updateStateOnServer")
+        if writeLog is not None:
+            writeLog.append((self.id, [{"key": key, "value": value}], None))
+        self.states[key] = value
+        if uiValue is not None:
+            self.states[key + ".ui"] = uiValue
+
+    def updateStatesOnServer(self, keyValueList, clearErrorState=True):
+        record("updateStatesOnServer")
+        if writeLog is not None:
+            writeLog.append((self.id, [dict(update) for update in keyValueList], None))
+        for update in keyValueList:
+            self.states[update["key"]] = update["value"]
+            if "uiValue" in update:
+                self.states[update["key"] + ".ui"] = update["uiValue"]
+
+    def updateStateImageOnServer(self, image):
+        record("updateStateImageOnServer")
+        if writeLog is not None:
+            writeLog.append((self.id, [], image))
+        self.displayStateImageSel = image
+
+    def replacePluginPropsOnServer(self, props):
+        record("replacePluginPropsOnServer")
+        self.pluginProps = Dict(props)
+
+    def stateListOrDisplayStateIdChanged(self):
+        record("stateListOrDisplayStateIdChanged")
+
+    def refreshFromServer(self):
+        record("refreshFromServer")
+
+
+class _DeviceList(dict):
+
+    def subscribeToChanges(self):
+        record("subscribeToChanges")
+
+    def __getitem__(self, key):
+        record("devices[]")
+        return dict.__getitem__(self, int(key))
+
+    def iter(self, filter=""):
+        record("devices.iter")
+        for dev in list(self.values()):
+            if not filter or filter == f"indigo.{dev.deviceClass}" or filter == f"indigo.{dev.protocol.split('.')[-1].lower()}":
+                yield dev
+
+    def add(self, dev):
+        dict.__setitem__(self, dev.id, dev)
+        return dev
+
+
+devices = _DeviceList()
+
+
+class _Commands(object):
+    def __init__(self, prefix, *names):
+        for name in names:
+            setattr(self, name, self.command(f"{prefix}.{name}"))
+
+    @staticmethod
+    def command(name):
+        def call(*args, **kwargs):
+            record(name)
+        return call
+
+
+device = _Commands("device", "turnOn", "turnOff", "toggle", "statusRequest", "enable")
+dimmer = _Commands("dimmer", "setBrightness", "brighten", "dim")
+relay = _Commands("relay", "turnOn", "turnOff", "toggle")
+sensor = _Commands("sensor", "setOnState")
+
+
+########################################
+# server
+
+class _PluginInfo(object):
+    """
+    What indigo.server.getPlugin() returns.  actionDelay simulates a slow base plugin.
+    """
+    actionDelay = 0.0
+
+    def __init__(self, pluginId, enabled=True):
+        self.pluginId = pluginId
+        self.enabled = enabled
+
+    def isEnabled(self):
+        record("plugin.isEnabled")
+        return self.enabled
+
+    def isRunning(self):
+        return self.enabled
+
+    def executeAction(self, actionId, deviceId=0, props=None, waitUntilDone=True):
+        record("plugin.executeAction")
+        if self.actionDelay:
+            time.sleep(self.actionDelay)
+
+
+class _Server(object):
+    def __init__(self):
+        self.installFolderPath = "/Library/Application Support/Perceptive Automation/Indigo 2022.1"
+        self.logsFolderPath = None
+        self.version = "2022.1.0"
+        self.apiVersion = "3.0"
+
+    def getPlugin(self, pluginId):
+        record("server.getPlugin")
+        return _PluginInfo(pluginId)
+
+    def getInstallFolderPath(self):
+        return self.installFolderPath
+
+    def getLogsFolderPath(self, pluginId=None):
+        path = self.logsFolderPath or f"{self.installFolderPath}/Logs"
+        return f"{path}/{pluginId}" if pluginId else path
+
+    def log(self, message, type=None, isError=False, level=logging.INFO):
+        logging.getLogger("Indigo").log(level, message)
+
+
+server = _Server()
+
+
+########################################
+# plugin base class
+
+THREADDEBUG = 5
+logging.addLevelName(THREADDEBUG, "THREADDEBUG")
+
+
+class _PluginLogger(logging.Logger):
+    def threaddebug(self, msg, *args, **kwargs):
+        if self.isEnabledFor(THREADDEBUG):
+            self._log(THREADDEBUG, msg, args, **kwargs)
+
+
+class PluginBase(object):
+
+    class StopThread(Exception):
+        pass
+
+    def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
+        self.pluginId = pluginId
+        self.pluginDisplayName = pluginDisplayName
+        self.pluginVersion = pluginVersion
+        self.pluginPrefs = pluginPrefs
+        self.stopThread = False
+
+        self.logger = _PluginLogger("Plugin")
+        self.logger.setLevel(THREADDEBUG)
+        self.indigo_log_handler = logging.StreamHandler()
+        self.plugin_file_handler = logging.NullHandler()
+        self.plugin_file_handler.setLevel(logging.DEBUG)
+        self.logger.addHandler(self.indigo_log_handler)
+        self.logger.addHandler(self.plugin_file_handler)
+
+    def sleep(self, seconds):
+        if self.stopThread:
+            raise self.StopThread()
+        time.sleep(seconds)
+
+    def stopConcurrentThread(self):
+        self.stopThread = True
+
+    def deviceCreated(self, dev):
+        pass
+
+    def deviceUpdated(self, origDev, newDev):
+        pass
+
+    def deviceDeleted(self, dev):
+        pass
+
+    def getDeviceStateList(self, dev):
+        return []
+
+    def getDeviceStateDictForNumberType(self, key, triggerLabel, controlPageLabel):
+        return Dict({"Key": key, "Type": 100, "TriggerLabel": triggerLabel, "StateLabel": controlPageLabel})
+
+    def getDeviceStateDictForRealType(self, key, triggerLabel, controlPageLabel):
+        return Dict({"Key": key, "Type": 150, "TriggerLabel": triggerLabel, "StateLabel": controlPageLabel})
+
+    def getDeviceStateDictForStringType(self, key, triggerLabel, controlPageLabel):
+        return Dict({"Key": key, "Type": 50, "TriggerLabel": triggerLabel, "StateLabel": controlPageLabel})
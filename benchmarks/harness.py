@@ -0,0 +1,185 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Loads the unmodified Masquerade plugin against fake_indigo and builds synthetic device databases.
+####################
+
+import atexit
+import builtins
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import types
+
+import fake_indigo as indigo
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_DIR = os.path.join(REPO, "Masquerade.indigoPlugin", "Contents", "Server Plugin")
+PLUGIN_ID = "com.flyingdiver.indigoplugin.masquerade"
+BASE_PLUGIN_ID = "com.example.indigoplugin.base"
+
+DEVICE_TYPES = ("masqSensor", "masqValueSensor", "masqDimmer", "masqSpeedControl", "masqSprinkler")
+AGGREGATE_TYPES = ("masqAggregateValue", "masqAggregateSensor")
+AGGREGATE_INPUTS = 12
+
+
+def loadPlugin(prefs=None, logLevel=30, folder=None):
+    """
+    Import plugin.py the way the Indigo plugin host does (with `indigo` as a builtin) and return a Plugin instance.
+
+    The fake server's install and log folders are pointed at folder (by default a new temporary directory,
+    removed at exit), so the plugin's warm state, trace and metrics files never touch a real Indigo install.
+    Pass the same folder again to restart a plugin over the state an earlier instance left.
+    """
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix="masquerade-bench-")
+        atexit.register(shutil.rmtree, folder, True)
+    indigo.server.installFolderPath = folder
+    indigo.server.logsFolderPath = os.path.join(folder, "Logs")
+
+    sys.modules["indigo"] = indigo
+    builtins.indigo = indigo
+    if PLUGIN_DIR not in sys.path:
+        sys.path.insert(0, PLUGIN_DIR)
+
+    path = os.path.join(PLUGIN_DIR, "plugin.py")
+    module = types.ModuleType("plugin")
+    module.__file__ = path
+    with open(path, "r", encoding="utf-8") as fp:
+        exec(compile(fp.read(), path, "exec"), module.__dict__)
+    sys.modules["plugin"] = module
+
+    pluginPrefs = indigo.Dict({"logLevel": str(logLevel)})
+    pluginPrefs.update(prefs or {})
+    return module.Plugin(PLUGIN_ID, "Masquerade", "bench", pluginPrefs)
+
+
+def resetDevices():
+    indigo.devices.clear()
+    indigo.resetCalls()
+
+
+########################################
+# synthetic devices
+
+def baseStates(rng):
+    return {
+        "temperature": round(rng.uniform(15.0, 25.0), 1),
+        "humidity": rng.randint(30, 60),
+        "power": round(rng.uniform(0.0, 3000.0), 1),
+        "motion": rng.choice(("on", "off")),
+        "level": rng.randint(0, 255),
+        "brightnessLevel": rng.randint(0, 100),
+        "onOffState": rng.random() < 0.5,
+    }
+
+
+def masqProps(deviceTypeId, baseId, rng, baseIds=()):
+    props = {"baseDevice": str(baseId), "deviceClass": "plugin", "devicePlugin": BASE_PLUGIN_ID}
+    if deviceTypeId in AGGREGATE_TYPES:
+        sources = rng.sample(list(baseIds), min(AGGREGATE_INPUTS, len(baseIds)))
+        if deviceTypeId == "masqAggregateValue":
+            state = rng.choice(("temperature", "humidity", "power"))
+            props.update(aggFunction=rng.choice(("mean", "min", "max", "sum")), masqSensorSubtype="Generic",
+                         aggInputs=json.dumps([[source, state] for source in sources]))
+        else:
+            props.update(aggFunction=rng.choice(("any", "all")), matchString="on", reverse=False, masqSensorSubtype="MotionSensor",
+                         aggInputs=json.dumps([[source, "motion"] for source in sources]))
+    if deviceTypeId == "masqSensor":
+        props.update(masqState="motion", matchString="on", reverse=False,
+                     masqSensorSubtype=rng.choice(("Generic", "MotionSensor", "Power")))
+    elif deviceTypeId == "masqValueSensor":
+        subtype, state = rng.choice((("Temperature-C", "temperature"), ("Humidity", "humidity"), ("Energy", "power"), ("Generic", "power")))
+        props.update(masqState=state, masqSensorSubtype=subtype)
+    elif deviceTypeId == "masqDimmer":
+        props.update(masqState="level", lowLimitState="0", highLimitState="255", reverseState=False,
+                     masqAction=rng.choice(("---", "setLevel")), masqValueField="level",
+                     lowLimitAction="0", highLimitAction="255", reverseAction=False, masqValueFormat="Decimal")
+    elif deviceTypeId == "masqSpeedControl":
+        props.update(scaleFactor="25")
+    return props
+
+
+def buildDatabase(masquerades, bases, seed=1, types=DEVICE_TYPES, extraProps=None):
+    """
+    Create `bases` base devices and `masquerades` masquerade devices spread evenly over `types`, each following a
+    random base device.  Returns (baseIds, masqDevices).
+    """
+    rng = random.Random(seed)
+    resetDevices()
+    baseIds = []
+    for i in range(bases):
+        dev = indigo.devices.add(indigo.Device(1000000 + i, f"Base {i:05d}", deviceTypeId="baseDevice", pluginId=BASE_PLUGIN_ID,
+                                               states=baseStates(rng), deviceClass="dimmer"))
+        baseIds.append(dev.id)
+
+    masqDevices = []
+    for i in range(masquerades):
+        deviceTypeId = types[i % len(types)]
+        props = masqProps(deviceTypeId, rng.choice(baseIds), rng, baseIds)
+        props.update(extraProps or {})
+        dev = indigo.devices.add(indigo.Device(2000000 + i, f"Masq {i:05d}", deviceTypeId=deviceTypeId, pluginId=PLUGIN_ID,
+                                               pluginProps=props))
+        masqDevices.append(dev)
+    return baseIds, masqDevices
+
+
+def startPlugin(plugin, masqDevices):
+    plugin.startup()
+    for dev in masqDevices:
+        plugin.deviceStartComm(dev)
+    finishStartup(plugin)
+
+
+def finishStartup(plugin, timeout=60.0):
+    # wait for any background startup work the plugin does
+    waitFor = getattr(plugin, "waitForStartup", None)
+    if waitFor is not None:
+        waitFor(timeout)
+
+
+def stopPlugin(plugin, masqDevices):
+    for dev in masqDevices:
+        plugin.deviceStopComm(dev)
+    plugin.shutdown()
+
+
+def mutate(dev, rng):
+    """
+    Return (oldDevice, newDevice) for a random state change on base device dev, updating the device in place.
+    """
+    old = dev.copy()
+    states = dev.states
+    which = rng.randrange(6)
+    if which == 0:
+        states["temperature"] = round(states["temperature"] + rng.choice((-0.1, 0.1)), 1)
+    elif which == 1:
+        states["humidity"] = max(0, min(100, states["humidity"] + rng.choice((-1, 1))))
+    elif which == 2:
+        states["power"] = round(max(0.0, states["power"] + rng.uniform(-50.0, 50.0)), 1)
+    elif which == 3:
+        states["motion"] = "off" if states["motion"] == "on" else "on"
+    elif which == 4:
+        states["level"] = rng.randint(0, 255)
+        states["brightnessLevel"] = rng.randint(0, 100)
+    else:
+        states["onOffState"] = not states["onOffState"]
+    return old, dev
+
+
+class Action(object):
+    """
+    Stand-in for the action objects passed to actionControlDevice/actionControlSpeedControl/actionControlSprinkler.
+    """
+
+    def __init__(self, deviceAction=None, speedControlAction=None, sprinklerAction=None, actionValue=None):
+        self.deviceAction = deviceAction
+        self.speedControlAction = speedControlAction
+        self.sprinklerAction = sprinklerAction
+        self.actionValue = actionValue
+
+    def __str__(self):
+        return f"deviceAction : {self.deviceAction}\nspeedControlAction : {self.speedControlAction}\nactionValue : {self.actionValue}"
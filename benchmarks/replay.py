@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Replays an event trace recorded by the plugin ("Record event trace" in the plugin config) into a
+# Plugin instance running against fake_indigo.
+#
+#   python benchmarks/replay.py trace.jsonl                      # as fast as possible
+#   python benchmarks/replay.py --speed 1 trace.jsonl            # real time
+#   python benchmarks/replay.py --speed 10 trace.jsonl.1 trace.jsonl --writes writes.jsonl
+#
+# Reports throughput and latency for the replayed events and the state writes they produced, as JSON.
+####################
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_indigo as indigo  # noqa: E402
+import harness  # noqa: E402
+from bench_plugin import latencyStats, serverCalls  # noqa: E402
+
+
+def readTrace(paths):
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def enumValue(enum, name):
+    # action values are recorded with str(); take the last component, e.g. "kDeviceAction.TurnOn" -> TurnOn
+    return getattr(enum, str(name).split(".")[-1])
+
+
+def makeDevice(record):
+    if record["e"] == "masq":
+        return indigo.Device(record["id"], record["name"], deviceTypeId=record["type"], pluginId=harness.PLUGIN_ID,
+                             pluginProps=record["props"])
+    protocol = enumValue(indigo.kProtocol, record.get("protocol") or "Plugin")
+    return indigo.Device(record["id"], record["name"], deviceTypeId=record.get("type", ""), pluginId=record.get("plugin", ""),
+                         protocol=protocol, states=record["states"])
+
+
+class Replayer(object):
+
+    def __init__(self, plugin, speed):
+        self.plugin = plugin
+        self.speed = speed
+        self.masqIds = set()
+        self.started = False
+        self.counts = {"u": 0, "d": 0, "a": 0, "dev": 0, "masq": 0}
+        self.samples = []
+
+    def setup(self, record):
+        # masquerade and base devices seen before the first event
+        dev = makeDevice(record)
+        indigo.devices.add(dev)
+        if record["e"] == "masq":
+            self.masqIds.add(dev.id)
+
+    def start(self):
+        self.plugin.startup()
+        for masqId in sorted(self.masqIds):
+            self.plugin.deviceStartComm(dict.__getitem__(indigo.devices, masqId))
+        harness.finishStartup(self.plugin)
+        self.started = True
+        # only count what the replayed events produce
+        indigo.resetCalls()
+        if indigo.writeLog is not None:
+            del indigo.writeLog[:]
+
+    def apply(self, record):
+        kind = record["e"]
+        self.counts[kind] = self.counts.get(kind, 0) + 1
+        plugin = self.plugin
+        devId = record["id"]
+
+        if kind == "masq":
+            current = dict.get(indigo.devices, devId)
+            if devId in self.masqIds and current is not None and dict(current.pluginProps) == record["props"]:
+                # repeated in the header of each rotated trace file
+                return
+            dev = makeDevice(record)
+            indigo.devices.add(dev)
+            if devId in self.masqIds:
+                plugin.deviceStopComm(dev)
+            self.masqIds.add(devId)
+            plugin.deviceStartComm(dev)
+            return
+
+        if devId in self.masqIds and kind in ("u", "dev"):
+            # the plugin's own output, recorded because it subscribes to all device changes
+            return
+
+        t0 = time.perf_counter_ns()
+        if kind == "u" or kind == "dev":
+            current = dict.get(indigo.devices, devId)
+            if current is None:
+                indigo.devices.add(makeDevice(record))
+                return
+            old = current.copy()
+            current.states.update(record["s"] if kind == "u" else record["states"])
+            plugin.deviceUpdated(old, current)
+        elif kind == "d":
+            current = dict.get(indigo.devices, devId)
+            if current is None:
+                return
+            dict.__delitem__(indigo.devices, devId)
+            plugin.deviceDeleted(current)
+        elif kind == "a":
+            dev = dict.get(indigo.devices, devId)
+            if dev is None:
+                return
+            method = record["fn"]
+            if method == "actionControlDevice":
+                action = harness.Action(deviceAction=enumValue(indigo.kDeviceAction, record["a"]), actionValue=record.get("v"))
+            elif method == "actionControlSpeedControl":
+                action = harness.Action(speedControlAction=enumValue(indigo.kSpeedControlAction, record["a"]), actionValue=record.get("v"))
+            else:
+                action = harness.Action(sprinklerAction=enumValue(indigo.kSprinklerAction, record["a"]))
+            getattr(plugin, method)(action, dev)
+        self.samples.append(time.perf_counter_ns() - t0)
+
+    def run(self, records):
+        firstTime = None
+        wallStart = None
+        for record in records:
+            if not self.started:
+                if record["e"] in ("masq", "dev"):
+                    self.setup(record)
+                    continue
+                self.start()
+                wallStart = time.perf_counter()
+            if self.speed and record.get("t") is not None:
+                if firstTime is None:
+                    firstTime = record["t"]
+                delay = (record["t"] - firstTime) / self.speed - (time.perf_counter() - wallStart)
+                if delay > 0:
+                    time.sleep(delay)
+            self.apply(record)
+        if not self.started:
+            self.start()
+            wallStart = time.perf_counter()
+
+        dispatcher = getattr(self.plugin, "dispatcher", None)
+        if dispatcher is not None:
+            dispatcher.drain(60.0)
+        return time.perf_counter() - wallStart
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("traces", nargs="+", help="trace files, oldest first")
+    parser.add_argument("-s", "--speed", type=float, default=0.0, help="replay speed multiplier (1 = real time), 0 for as fast as possible")
+    parser.add_argument("-w", "--writes", help="write every state write the plugin made to this JSON lines file")
+    parser.add_argument("-o", "--output", help="write JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    harness.resetDevices()
+    indigo.writeLog = []
+    plugin = harness.loadPlugin()
+    replayer = Replayer(plugin, args.speed)
+    elapsed = replayer.run(readTrace(args.traces))
+    calls = serverCalls()
+    events = len(replayer.samples)
+
+    writes = indigo.writeLog
+    indigo.writeLog = None
+    result = {"traces": args.traces, "speed": args.speed, "masquerades": len(replayer.masqIds),
+              "records": replayer.counts, "events": events, "elapsed_s": round(elapsed, 4),
+              "events_per_s": round(events / elapsed, 1) if elapsed else 0.0,
+              "server_calls": calls, "server_calls_per_event": round(calls / events, 4) if events else 0.0,
+              "calls_by_name": dict(indigo.calls),
+              "state_writes": sum(len(updates) for devId, updates, image in writes),
+              "image_writes": sum(1 for devId, updates, image in writes if image is not None)}
+    result.update(latencyStats(replayer.samples))
+
+    if args.writes:
+        with open(args.writes, "w") as fp:
+            for devId, updates, image in writes:
+                fp.write(json.dumps({"id": devId, "states": updates, "image": image}, default=str) + "\n")
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    harness.stopPlugin(plugin, [dict.__getitem__(indigo.devices, masqId) for masqId in replayer.masqIds
+                                if dict.__contains__(indigo.devices, masqId)])
+
+
+if __name__ == "__main__":
+    main()